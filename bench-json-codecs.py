@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+import argparse
+import os
+import sys
+import timeit
+
+import client as rapi
+
+DEFAULT_REPEAT = 5
+# Each measurement runs for at least this long, small responses are decoded several times
+MIN_MEASURE_SECONDS = 0.2
+
+
+class RecordingCodec(rapi.JsonCodec):
+    def __init__(self):
+        super().__init__()
+        self.last_body = None
+
+    def Decode(self, data):
+        self.last_body = bytes(data)
+        return super().Decode(data)
+
+
+def record_responses(directory, host, username, password):
+    codec = RecordingCodec()
+    client = rapi.GanetiRapiClient(host, username=username, password=password, json_codec=codec)
+    requests = [
+        ("instances-bulk", lambda: client.GetInstances(bulk=True)),
+        ("nodes-bulk", lambda: client.GetNodes(bulk=True)),
+        ("jobs-bulk", lambda: client.GetJobs(bulk=True)),
+        ("query-instance", lambda: client.Query("instance", ["name", "status", "tags", "pnode", "snodes",
+                                                             "disk.sizes", "nic.macs", "oper_state"])),
+    ]
+    os.makedirs(directory, exist_ok=True)
+    for name, request in requests:
+        request()
+        path = os.path.join(directory, "%s.json" % name)
+        with open(path, "wb") as f:
+            f.write(codec.last_body)
+        print("Recorded %s (%.1f KiB)" % (path, len(codec.last_body) / 1024))
+
+
+def measure(fn, repeat):
+    timer = timeit.Timer(fn)
+    number, elapsed = timer.autorange()
+    while elapsed < MIN_MEASURE_SECONDS:
+        number *= 2
+        elapsed = timer.timeit(number)
+    return min(timer.repeat(repeat, number)) / number
+
+
+def run_benchmark(files, codec_names, repeat):
+    codecs = [rapi.GetJsonCodec(name) for name in codec_names]
+    baseline = rapi.GetJsonCodec("json")
+    print("%-24s %-12s %10s %10s %10s %10s %8s" % ("Response", "Codec", "Size KiB", "Decode ms", "MiB/s",
+                                                  "Encode ms", "vs json"))
+    for path in files:
+        # Decoded from a bytearray, like the client does
+        with open(path, "rb") as f:
+            body = bytearray(f.read())
+        data = baseline.Decode(body)
+        baseline_time = measure(lambda: baseline.Decode(body), repeat)
+        for codec in codecs:
+            if codec.Decode(body) != data:
+                print("Error: %s decodes %s differently" % (codec.name, path))
+                sys.exit(1)
+            decode_time = measure(lambda: codec.Decode(body), repeat)
+            encode_time = measure(lambda: codec.Encode(data), repeat)
+            print("%-24s %-12s %10.1f %10.3f %10.1f %10.3f %7.2fx" % (
+                os.path.basename(path), codec.name, len(body) / 1024, decode_time * 1000,
+                len(body) / decode_time / 2 ** 20, encode_time * 1000, baseline_time / decode_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the JSON codecs of the RAPI client on recorded responses")
+    parser.add_argument('mode', choices=["record", "run"])
+    parser.add_argument('files', nargs='*', help="recorded responses to decode (run mode)")
+    parser.add_argument('--directory', default="json-responses", help="where to store the responses (record mode)")
+    parser.add_argument('--host', default="localhost")
+    parser.add_argument('--username', default="rapi")
+    parser.add_argument('--password', default="gnt-build-setup")
+    parser.add_argument('--codec', action='append', default=None,
+                        help="codec to compare, may be given several times (default: all installed)")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT)
+
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        record_responses(args.directory, args.host, args.username, args.password)
+    else:
+        if not args.files:
+            print("Error: please specify the recorded responses to decode")
+            sys.exit(1)
+        codec_names = args.codec or rapi.GetJsonCodecNames()
+        for name in codec_names:
+            if name not in rapi.GetJsonCodecNames():
+                print("Error: the JSON codec '%s' is not installed, available: %s" % (
+                    name, ", ".join(rapi.GetJsonCodecNames())))
+                sys.exit(1)
+        run_benchmark(args.files, codec_names, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""Ansible callback plugin recording how long each task and role takes.
+
+The timings are written as JSON to the file named by the
+GANETI_QA_ANSIBLE_TIMINGS environment variable once the playbook finishes
+(also when it fails). Without that variable the plugin does nothing.
+"""
+
+import json
+import os
+import time
+
+from ansible.plugins.callback import CallbackBase
+
+DOCUMENTATION = '''
+    name: phase_timings
+    type: aggregate
+    short_description: write per-task and per-role timings to a JSON file
+    description:
+      - Records the wall clock time of every task and sums it up per role.
+    requirements:
+      - enable in ansible.cfg via callbacks_enabled
+'''
+
+TIMINGS_FILE_ENV = "GANETI_QA_ANSIBLE_TIMINGS"
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'phase_timings'
+    CALLBACK_NEEDS_ENABLED = True
+
+    def __init__(self):
+        super(CallbackModule, self).__init__()
+        self.timings_file = os.environ.get(TIMINGS_FILE_ENV)
+        self.started = time.time()
+        self.play = None
+        self.tasks = []
+        self.current = None
+
+    def _finish_current_task(self):
+        if self.current is not None:
+            self.current['duration'] = time.time() - self.current['start']
+            self.current = None
+
+    def _start_task(self, task, handler=False):
+        self._finish_current_task()
+        role = task._role.get_name() if task._role else None
+        self.current = {
+            'play': self.play,
+            'role': role,
+            'task': task.get_name(),
+            'action': task.action,
+            'handler': handler,
+            'start': time.time(),
+            'duration': None,
+            'hosts': {},
+        }
+        self.tasks.append(self.current)
+
+    def _record_result(self, result, status):
+        if self.current is not None:
+            self.current['hosts'][result._host.get_name()] = status
+
+    def v2_playbook_on_play_start(self, play):
+        self._finish_current_task()
+        self.play = play.get_name()
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._start_task(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._start_task(task, handler=True)
+
+    def v2_runner_on_ok(self, result):
+        self._record_result(result, 'changed' if result._result.get('changed') else 'ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False):
+        self._record_result(result, 'ignored' if ignore_errors else 'failed')
+
+    def v2_runner_on_skipped(self, result):
+        self._record_result(result, 'skipped')
+
+    def v2_runner_on_unreachable(self, result):
+        self._record_result(result, 'unreachable')
+
+    def v2_playbook_on_stats(self, stats):
+        self._finish_current_task()
+        if not self.timings_file:
+            return
+
+        roles = {}
+        for task in self.tasks:
+            name = task['role'] or '(playbook)'
+            roles[name] = roles.get(name, 0) + task['duration']
+
+        data = {
+            'started': self.started,
+            'duration': time.time() - self.started,
+            'roles': roles,
+            'tasks': self.tasks,
+        }
+        tmp_file = self.timings_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp_file, self.timings_file)
@@ -42,8 +42,12 @@
 # No Ganeti-specific modules should be imported. The RAPI client is supposed to
 # be standalone.
 
+import asyncio
+import atexit
+import json
 import logging
 import socket
+import sys
 import threading
 import time
 
@@ -53,9 +57,22 @@ except ImportError:
     from urllib.parse import urlencode
 
 import pycurl
-import simplejson
 
-from io import StringIO, BytesIO
+# Optional, faster JSON modules
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+try:
+  import ujson
+except ImportError:
+  ujson = None
+
+try:
+  import simplejson
+except ImportError:
+  simplejson = None
 
 GANETI_RAPI_PORT = 5080
 GANETI_RAPI_VERSION = 2
@@ -112,6 +129,39 @@ _REQ_DATA_VERSION_FIELD = "__version__"
 _QPARAM_DRY_RUN = "dry-run"
 _QPARAM_FORCE = "force"
 
+#: HTTP codes returned by servers which can't wait for job changes
+_WFJC_UNSUPPORTED_CODES = frozenset([404, 405, 501])
+
+#: HTTP codes returned by servers which can't query jobs via L{Query}
+_QUERY_JOB_UNSUPPORTED_CODES = frozenset([404, 501])
+
+#: Path segments following one of these are object names or ids
+_REQ_COLLECTIONS = frozenset([
+  "instances", "nodes", "groups", "networks", "jobs", "filters",
+  ])
+
+#: Name in L{RequestTrace.timings} and the C{pycurl} info it is taken from
+_CURL_TIMINGS = [
+  ("namelookup", "NAMELOOKUP_TIME"),
+  ("connect", "CONNECT_TIME"),
+  ("appconnect", "APPCONNECT_TIME"),
+  ("starttransfer", "STARTTRANSFER_TIME"),
+  ("total", "TOTAL_TIME"),
+  ]
+
+#: Job fields reported by L{GanetiRapiClient.WaitForJob}
+_WAIT_JOB_FIELDS = ["status", "opresult"]
+
+#: Query filter operators, as understood by Ganeti's query language
+QFILTER_OR = "|"
+QFILTER_AND = "&"
+QFILTER_NOT = "!"
+QFILTER_TRUE = "?"
+QFILTER_EQUAL = "="
+QFILTER_NOT_EQUAL = "!="
+QFILTER_REGEXP = "=~"
+QFILTER_CONTAINS = "=[]"
+
 # Feature strings
 INST_CREATE_REQV1 = "instance-create-reqv1"
 INST_REINSTALL_REQV1 = "instance-reinstall-reqv1"
@@ -205,6 +255,13 @@ class CertificateError(GanetiApiError):
   pass
 
 
+class JobWaitTimeout(GanetiApiError):
+  """Raised when jobs didn't finish within the given time.
+
+  """
+  pass
+
+
 def EpochNano():
   """Return the current timestamp expressed as number of nanoseconds since the
   unix epoch
@@ -258,6 +315,104 @@ def _SetItemIf(container, condition, item, value):
   return condition
 
 
+def _QueryFilterOperands(op, filters):
+  """Combines query filters with a boolean operator.
+
+  C{None} filters (i.e. "no restriction") are left out.
+
+  """
+  operands = [qfilter for qfilter in filters if qfilter is not None]
+  if not operands:
+    return None
+  elif len(operands) == 1:
+    return operands[0]
+  return [op] + operands
+
+
+def QueryFilterAnd(*filters):
+  """Builds a query filter matching items matched by all given filters.
+
+  @rtype: list or None
+  @return: Query filter, C{None} if no filter was given
+
+  """
+  return _QueryFilterOperands(QFILTER_AND, filters)
+
+
+def QueryFilterOr(*filters):
+  """Builds a query filter matching items matched by any given filter.
+
+  @rtype: list or None
+  @return: Query filter, C{None} if no filter was given
+
+  """
+  return _QueryFilterOperands(QFILTER_OR, filters)
+
+
+def QueryFilterNot(qfilter):
+  """Negates a query filter.
+
+  """
+  return [QFILTER_NOT, qfilter]
+
+
+def QueryFilterTrue(field):
+  """Builds a query filter matching items whose field is true.
+
+  """
+  return [QFILTER_TRUE, field]
+
+
+def QueryFilterEqual(field, value):
+  """Builds a query filter matching items whose field equals a value.
+
+  """
+  return [QFILTER_EQUAL, field, value]
+
+
+def QueryFilterNotEqual(field, value):
+  """Builds a query filter matching items whose field differs from a value.
+
+  """
+  return [QFILTER_NOT_EQUAL, field, value]
+
+
+def QueryFilterRegexp(field, pattern):
+  """Builds a query filter matching items whose field matches a regular
+  expression.
+
+  """
+  return [QFILTER_REGEXP, field, pattern]
+
+
+def QueryFilterContains(field, value):
+  """Builds a query filter matching items whose list field contains a value.
+
+  E.g. C{QueryFilterContains("tags", "foo")} for instances tagged "foo".
+
+  """
+  return [QFILTER_CONTAINS, field, value]
+
+
+def QueryFilterAny(field, values, build_fn=QueryFilterEqual):
+  """Builds a query filter matching items where any value matches the field.
+
+  @type field: string
+  @param field: Field name
+  @type values: list
+  @param values: Values to look for
+  @param build_fn: Filter builder applied to C{field} and each value, e.g.
+                   L{QueryFilterContains} for list fields
+  @rtype: list
+  @return: Query filter, matching nothing if C{values} is empty
+
+  """
+  if not values:
+    # An empty disjunction is false
+    return [QFILTER_OR]
+  return QueryFilterOr(*[build_fn(field, value) for value in values])
+
+
 def UsesRapiClient(fn):
   """Decorator for code using RAPI client to initialize pycURL.
 
@@ -382,34 +537,623 @@ def GenericCurlConfig(verbose=False, use_signal=False,
   return _ConfigCurl
 
 
-class _CompatIO(object):
-  """ Stream that lazy-allocates its buffer based on the first write's type
+def _CurlErrorToApiError(err):
+  """Converts a C{pycurl.error} into the corresponding exception.
+
+  @type err: pycurl.error
+  @rtype: L{GanetiApiError}
+
+  """
+  if err.args[0] in _CURL_SSL_CERT_ERRORS:
+    return CertificateError("SSL certificate error %s" % err, code=err.args[0])
+
+  return GanetiApiError(str(err), code=err.args[0])
+
+
+class JsonCodec(object):
+  """Encodes request bodies and decodes response bodies.
+
+  This codec uses the C{json} module of the standard library and is always
+  available. Subclasses use faster third-party modules, see
+  L{GetJsonCodec}. Own codecs can be passed to L{GanetiRapiClient} as well.
+
+  """
+  #: Name used to select the codec in L{GetJsonCodec}
+  name = "json"
+  #: Module the codec needs, C{None} if it is not installed
+  module = json
+
+  def __init__(self, sort_keys=False):
+    """Initializes this class.
+
+    @type sort_keys: bool
+    @param sort_keys: Whether to sort the keys of encoded objects, which
+                      gives reproducible request bodies at some cost
+
+    """
+    self.sort_keys = sort_keys
+    self._encoder = json.JSONEncoder(sort_keys=sort_keys)
+
+  @classmethod
+  def IsAvailable(cls):
+    """Returns whether the module needed by the codec is installed.
+
+    """
+    return cls.module is not None
+
+  def Encode(self, data):
+    """Encodes data as UTF-8 encoded JSON.
+
+    @rtype: bytes
+
+    """
+    return self._encoder.encode(data).encode("utf-8")
+
+  def Decode(self, data):
+    """Decodes a UTF-8 encoded JSON document.
+
+    @type data: bytes or bytearray
+    @param data: Response body
+
+    """
+    return json.loads(data)
+
+
+class _SimplejsonCodec(JsonCodec):
+  """JSON codec using C{simplejson}.
+
+  """
+  name = "simplejson"
+  module = simplejson
+
+  def __init__(self, sort_keys=False):
+    JsonCodec.__init__(self, sort_keys=sort_keys)
+    self._encoder = simplejson.JSONEncoder(sort_keys=sort_keys)
+
+  def Decode(self, data):
+    return simplejson.loads(data.decode("utf-8"))
+
+
+class _UjsonCodec(JsonCodec):
+  """JSON codec using C{ujson}.
+
+  """
+  name = "ujson"
+  module = ujson
+
+  def Encode(self, data):
+    return ujson.dumps(data, sort_keys=self.sort_keys).encode("utf-8")
+
+  def Decode(self, data):
+    return ujson.loads(bytes(data))
+
+
+class _OrjsonCodec(JsonCodec):
+  """JSON codec using C{orjson}.
+
+  C{orjson} decodes straight from the response buffer without copying it.
+
+  """
+  name = "orjson"
+  module = orjson
+
+  def Encode(self, data):
+    option = orjson.OPT_NON_STR_KEYS
+    if self.sort_keys:
+      option |= orjson.OPT_SORT_KEYS
+    return orjson.dumps(data, option=option)
+
+  def Decode(self, data):
+    return orjson.loads(data)
+
+
+#: JSON codecs, fastest first
+_JSON_CODECS = [
+  _OrjsonCodec,
+  _UjsonCodec,
+  _SimplejsonCodec,
+  JsonCodec,
+  ]
+
+
+def GetJsonCodecNames():
+  """Returns the names of all installed JSON codecs, fastest first.
+
+  @rtype: list of string
+
+  """
+  return [cls.name for cls in _JSON_CODECS if cls.IsAvailable()]
+
+
+def GetJsonCodec(name=None, sort_keys=False):
+  """Returns a JSON codec.
+
+  @type name: string or None
+  @param name: Name of the codec, C{None} for the fastest installed one
+  @type sort_keys: bool
+  @param sort_keys: Whether to sort the keys of encoded objects
+  @rtype: L{JsonCodec}
+  @raises Error: If the requested codec is unknown or not installed
+
+  """
+  for cls in _JSON_CODECS:
+    if cls.IsAvailable() and name in (None, cls.name):
+      return cls(sort_keys=sort_keys)
+
+  raise Error("JSON codec '%s' is not available" % name)
+
+
+class _CurlPool(object):
+  """Bounded pool of reusable cURL objects.
+
+  Keeping configured C{pycurl.Curl} objects around lets libcurl reuse
+  keep-alive connections and TLS sessions between requests. At most C{size}
+  objects are handed out at the same time, further callers block until one is
+  returned. Objects which have been idle for longer than C{idle_timeout}
+  seconds are closed on the next checkout.
+
+  """
+  def __init__(self, factory, size, idle_timeout=None, _time_fn=time.time):
+    """Initializes this class.
+
+    @type factory: callable
+    @param factory: Function returning a new, fully configured cURL object
+    @type size: int
+    @param size: Maximum number of cURL objects in use at the same time
+    @type idle_timeout: number or None
+    @param idle_timeout: Seconds after which an unused cURL object is closed,
+                         C{None} to keep them forever
+
+    """
+    if size < 1:
+      raise Error("Pool size must be at least 1")
+
+    self.size = size
+    self._factory = factory
+    self._idle_timeout = idle_timeout
+    self._time_fn = _time_fn
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(size)
+    # List of (curl, last use) tuples, most recently used last
+    self._idle = []
+
+  def _EvictIdle(self):
+    """Closes cURL objects which haven't been used for too long.
+
+    @note: Must be called with the lock held
+
+    """
+    if self._idle_timeout is None:
+      return
+
+    cutoff = self._time_fn() - self._idle_timeout
+    while self._idle and self._idle[0][1] < cutoff:
+      (curl, _) = self._idle.pop(0)
+      curl.close()
+
+  def Acquire(self):
+    """Checks out a cURL object, creating a new one if none is idle.
+
+    @rtype: pycurl.Curl
+
+    """
+    self._slots.acquire()
+    try:
+      with self._lock:
+        self._EvictIdle()
+        if self._idle:
+          return self._idle.pop()[0]
+
+      return self._factory()
+    except:
+      self._slots.release()
+      raise
+
+  def Release(self, curl, discard=False):
+    """Returns a cURL object to the pool.
+
+    @type discard: bool
+    @param discard: Whether to close the object instead of keeping it, e.g.
+                    after a transfer error left its connection in an unknown
+                    state
+
+    """
+    try:
+      if discard:
+        curl.close()
+      else:
+        with self._lock:
+          self._idle.append((curl, self._time_fn()))
+    finally:
+      self._slots.release()
+
+  def Close(self):
+    """Closes all idle cURL objects.
+
+    """
+    with self._lock:
+      while self._idle:
+        self._idle.pop()[0].close()
+
+
+def _GetJobsFromQuery(result):
+  """Extracts the job results from a L{GanetiRapiClient.Query} on jobs.
+
+  @rtype: dict
+  @return: dictionary mapping job ids to dicts with the fields from
+           L{_WAIT_JOB_FIELDS}
+
+  """
+  return dict((int(row[0][1]),
+               dict(zip(_WAIT_JOB_FIELDS, [value for (_, value) in row[1:]])))
+              for row in result["data"])
+
+
+def _GetJobsFromList(jobs, job_ids):
+  """Extracts the results of some jobs from a bulk job list.
+
+  @see: L{_GetJobsFromQuery}
+
+  """
+  return dict((int(job["id"]),
+               dict((name, job[name]) for name in _WAIT_JOB_FIELDS))
+              for job in jobs
+              if int(job["id"]) in job_ids)
+
+
+class _JobWaitState(object):
+  """State of waiting for a single job.
+
+  Used by the synchronous and the asynchronous client, which only differ in
+  how they send requests and sleep.
+
+  """
+  def __init__(self, job_id, log_fn, min_period, max_period):
+    """Initializes this class.
+
+    @see: L{GanetiRapiClient.WaitForJob}
+
+    """
+    self.job_id = job_id
+    self.prev_job_info = None
+    self.prev_log_serial = None
+    #: Seconds to wait before polling again
+    self.period = min_period
+    self._log_fn = log_fn
+    self._min_period = min_period
+    self._max_period = max_period
+    self._prev_status = None
+
+  def _AddLogEntries(self, entries):
+    """Passes log entries not seen before to the log function.
+
+    """
+    for entry in entries:
+      if self.prev_log_serial is None or entry[0] > self.prev_log_serial:
+        self.prev_log_serial = entry[0]
+        if self._log_fn:
+          self._log_fn(entry)
+
+  def ProcessChange(self, result):
+    """Processes the result of L{GanetiRapiClient.WaitForJobChange}.
+
+    @rtype: dict or None
+    @return: the finished job's C{status} and C{opresult}, C{None} while it
+             is still running
+
+    """
+    if result is None:
+      # Server-side timeout without any change
+      return None
+
+    job_info = result["job_info"]
+    if job_info is None:
+      raise GanetiApiError("Job %s disappeared while waiting for it" %
+                           self.job_id, code=HTTP_NOT_FOUND)
+
+    self._AddLogEntries(result["log_entries"])
+
+    if job_info[0] in JOB_STATUS_FINALIZED:
+      return dict(zip(_WAIT_JOB_FIELDS, job_info))
+
+    self.prev_job_info = job_info
+    return None
+
+  def ProcessPoll(self, job):
+    """Processes the result of L{GanetiRapiClient.GetJobStatus}.
+
+    The polling interval starts at C{min_period} after every status change
+    and doubles up to C{max_period} while the job doesn't change.
+
+    @see: L{ProcessChange}
+
+    """
+    self._AddLogEntries(e for oplog in job.get("oplog") or [] for e in oplog)
+
+    if job["status"] in JOB_STATUS_FINALIZED:
+      return dict((name, job[name]) for name in _WAIT_JOB_FIELDS)
+
+    if job["status"] != self._prev_status:
+      self._prev_status = job["status"]
+      self.period = self._min_period
+    else:
+      self.period = min(self.period * 2, self._max_period)
+
+    return None
+
+
+class _JobsWaitState(object):
+  """State of waiting for several jobs.
+
+  @see: L{_JobWaitState}
+
+  """
+  def __init__(self, job_ids, timeout, min_period, max_period, time_fn):
+    """Initializes this class.
+
+    @see: L{GanetiRapiClient.WaitForJobs}
+
+    """
+    #: Ids of the jobs which haven't finished yet
+    self.pending = set(int(job_id) for job_id in job_ids)
+    if timeout is not None:
+      self._deadline = time_fn() + timeout
+    else:
+      self._deadline = None
+    self._period = min_period
+    self._min_period = min_period
+    self._max_period = max_period
+    self._time_fn = time_fn
+
+  def ProcessStatus(self, jobs):
+    """Processes the status of the pending jobs.
+
+    @type jobs: dict
+    @param jobs: result of L{GanetiRapiClient._GetJobsStatus}
+    @rtype: list
+    @return: C{(job_id, result)} tuples of the jobs which finished
+
+    @raises GanetiApiError: if a job is unknown
+
+    """
+    missing = self.pending - set(jobs)
+    if missing:
+      raise GanetiApiError("Unknown job(s) %s" %
+                           ", ".join(str(i) for i in sorted(missing)),
+                           code=HTTP_NOT_FOUND)
+
+    finished = sorted(job_id for job_id in self.pending
+                      if jobs[job_id]["status"] in JOB_STATUS_FINALIZED)
+    self.pending.difference_update(finished)
+
+    if finished:
+      self._period = self._min_period
+    else:
+      self._period = min(self._period * 2, self._max_period)
+
+    return [(job_id, jobs[job_id]) for job_id in finished]
+
+  def GetSleepPeriod(self):
+    """Returns how long to wait before fetching the status again.
+
+    @raises JobWaitTimeout: if the timeout expired
+
+    """
+    if self._deadline is None:
+      return self._period
+
+    remaining = self._deadline - self._time_fn()
+    if remaining <= 0:
+      raise JobWaitTimeout("Timeout while waiting for job(s) %s" %
+                           ", ".join(str(i) for i in sorted(self.pending)))
+
+    return min(self._period, remaining)
+
 
-  This is a wrapper around BytesIO/StringIO that will allocate the
-  respective internal buffer based on whether the first write is bytes or
-  not. It is intended to be used with PycURL, which returns the response as
-  bytes in Python 3 and string in Python 2.
+def GetRequestEndpoint(path):
+  """Returns the endpoint of a RAPI path, without names or ids.
+
+  For example, C{/2/instances/inst1.example.com/shutdown} becomes
+  C{/2/instances/:name/shutdown}. This keeps the number of distinct
+  endpoints small enough to aggregate statistics by them.
+
+  @type path: string
+  @param path: HTTP URL path, without query arguments
+  @rtype: string
+
+  """
+  parts = path.split("/")
+  for idx in range(1, len(parts)):
+    if parts[idx - 1] in _REQ_COLLECTIONS and parts[idx]:
+      if parts[idx - 1] == "jobs":
+        parts[idx] = ":id"
+      else:
+        parts[idx] = ":name"
+  return "/".join(parts)
+
+
+class RequestTrace(object):
+  """Information about a single RAPI request, passed to request hooks.
+
+  The cURL timings are cumulative seconds since the start of the transfer as
+  reported by libcurl, e.g. C{appconnect} includes the time spent in
+  C{connect}. They are zero for steps which did not happen, such as name
+  lookups and TLS handshakes on reused connections.
+
+  """
+  def __init__(self, method, path, _time_fn=time.time):
+    """Initializes this class.
+
+    @type method: string
+    @param method: HTTP method
+    @type path: string
+    @param path: HTTP URL path, without query arguments
+
+    """
+    self.method = method
+    self.path = path
+    self.endpoint = GetRequestEndpoint(path)
+    self.start = _time_fn()
+    #: Wall clock seconds including waiting for a pooled cURL object
+    self.duration = None
+    #: HTTP status code, C{None} if no response was received
+    self.status = None
+    self.bytes_out = 0
+    self.bytes_in = 0
+    #: Dictionary of cURL timing name to seconds, see L{_CURL_TIMINGS}
+    self.timings = {}
+    self._time_fn = _time_fn
+
+  def _Finish(self, curl, received):
+    """Records the results of the transfer.
+
+    @param curl: cURL object used for the request
+    @type received: bool
+    @param received: Whether a response was received
+
+    """
+    self.duration = self._time_fn() - self.start
+    if received:
+      self.status = curl.getinfo(pycurl.RESPONSE_CODE)
+    self.bytes_out = int(curl.getinfo(pycurl.SIZE_UPLOAD))
+    self.bytes_in = int(curl.getinfo(pycurl.SIZE_DOWNLOAD))
+    for (name, info) in _CURL_TIMINGS:
+      self.timings[name] = curl.getinfo(getattr(pycurl, info))
+
+
+class RequestHook(object):
+  """Base class for request hooks.
+
+  Hooks are called for every request sent by a client they have been added
+  to, see L{GanetiRapiClient.AddRequestHook}. They are called from the thread
+  sending the request and must therefore be thread-safe. Exceptions raised by
+  hooks are logged and otherwise ignored.
+
+  """
+  def BeforeRequest(self, trace):
+    """Called before a request is sent.
+
+    @type trace: L{RequestTrace}
+    @param trace: Request, only C{method}, C{path} and C{start} are set
+
+    """
+
+  def AfterRequest(self, trace):
+    """Called once a request finished, also if it failed.
+
+    @type trace: L{RequestTrace}
+    @param trace: Finished request
+
+    """
+
+
+class RequestStatsAggregator(RequestHook):
+  """Request hook summing up request statistics per endpoint.
+
+  Besides the total time, the summary splits the cURL timings into name
+  lookup, TCP connect, TLS handshake, waiting for the first response byte
+  (i.e. server processing) and the transfer of the response. Comparing the
+  wall clock time with the cURL total shows how long requests waited for a
+  pooled cURL object.
 
   """
   def __init__(self):
-    self.buffer = None
+    """Initializes this class.
 
-  def write(self, data, *args, **kwargs):
-    if self.buffer is None:
-      self.buffer = BytesIO() if isinstance(data, bytes) else StringIO()
-    return self.buffer.write(data, *args, **kwargs)
+    """
+    RequestHook.__init__(self)
+    self._lock = threading.Lock()
+    # Dictionary of (method, endpoint) to dictionary of sums
+    self._stats = {}
 
-  def read(self, *args, **kwargs):
-    return self.buffer.read(*args, **kwargs)
+  def AfterRequest(self, trace):
+    """Adds a finished request to the statistics.
 
-  def tell(self):
-    if self.buffer is None:
-      # We were never written to
-      return 0
-    return self.buffer.tell()
+    """
+    timings = trace.timings
+    connected = max(timings.get("connect", 0), timings.get("appconnect", 0))
+    first_byte = timings.get("starttransfer", 0)
+    total = timings.get("total", 0)
+    phases = [
+      ("wall", trace.duration),
+      ("total", total),
+      ("dns", timings.get("namelookup", 0)),
+      ("tcp", max(0, timings.get("connect", 0) -
+                  timings.get("namelookup", 0))),
+      ("tls", max(0, timings.get("appconnect", 0) -
+                  timings.get("connect", 0))),
+      ("wait", max(0, first_byte - connected)),
+      ("transfer", max(0, total - first_byte)),
+      ]
 
-  def seek(self, *args, **kwargs):
-    return self.buffer.seek(*args, **kwargs)
+    with self._lock:
+      stats = self._stats.setdefault((trace.method, trace.endpoint), {
+        "requests": 0,
+        "errors": 0,
+        "bytes_out": 0,
+        "bytes_in": 0,
+        "max_wall": 0,
+        })
+      stats["requests"] += 1
+      if trace.status != HTTP_OK:
+        stats["errors"] += 1
+      stats["bytes_out"] += trace.bytes_out
+      stats["bytes_in"] += trace.bytes_in
+      stats["max_wall"] = max(stats["max_wall"], trace.duration)
+      for (name, value) in phases:
+        stats[name] = stats.get(name, 0) + value
+
+  def GetStats(self):
+    """Returns the statistics per endpoint.
+
+    @rtype: dict
+    @return: Dictionary of (method, endpoint) to dictionary of counters and
+             summed up seconds
+
+    """
+    with self._lock:
+      return dict((key, dict(value)) for (key, value) in self._stats.items())
+
+  def FormatSummary(self):
+    """Formats the statistics as a table, slowest endpoints first.
+
+    @rtype: string
+
+    """
+    header = ("%-6s %-40s %6s %4s %8s %8s %7s %7s %7s %8s %8s %9s %9s" %
+              ("Method", "Endpoint", "Count", "Err", "Avg wall", "Max wall",
+               "DNS", "TCP", "TLS", "Server", "Transfer", "KiB out",
+               "KiB in"))
+    lines = [header]
+
+    stats = sorted(self.GetStats().items(),
+                   key=lambda item: item[1]["wall"], reverse=True)
+    for ((method, endpoint), values) in stats:
+      count = values["requests"]
+      lines.append("%-6s %-40s %6d %4d %7.3fs %7.3fs %6.3fs %6.3fs %6.3fs"
+                   " %7.3fs %7.3fs %9.1f %9.1f" %
+                   (method, endpoint, count, values["errors"],
+                    values["wall"] / count, values["max_wall"],
+                    values["dns"] / count, values["tcp"] / count,
+                    values["tls"] / count, values["wait"] / count,
+                    values["transfer"] / count,
+                    values["bytes_out"] / 1024.0,
+                    values["bytes_in"] / 1024.0))
+
+    return "\n".join(lines)
+
+  def DumpAtExit(self, stream=None):
+    """Writes the summary to a stream when the interpreter exits.
+
+    @param stream: File object to write to, defaults to C{sys.stderr}
+
+    """
+    def _Dump():
+      if self._stats:
+        (stream or sys.stderr).write("RAPI requests by endpoint:\n%s\n" %
+                                     self.FormatSummary())
+
+    atexit.register(_Dump)
 
 
 class GanetiRapiClient(object): # pylint: disable=R0904
@@ -417,11 +1161,12 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
   """
   USER_AGENT = "Ganeti RAPI Client"
-  _json_encoder = simplejson.JSONEncoder(sort_keys=True)
 
   def __init__(self, host, port=GANETI_RAPI_PORT,
                username=None, password=None, logger=logging,
-               curl_config_fn=None, curl_factory=None):
+               curl_config_fn=None, curl_factory=None,
+               pool_size=None, pool_idle_timeout=60, capability_ttl=None,
+               request_hooks=None, json_codec=None):
     """Initializes this class.
 
     @type host: string
@@ -435,6 +1180,22 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @type curl_config_fn: callable
     @param curl_config_fn: Function to configure C{pycurl.Curl} object
     @param logger: Logging object
+    @type pool_size: int or None
+    @param pool_size: If set, keep up to this many cURL objects around and
+                      reuse them (and thereby their connections) for
+                      subsequent requests
+    @type pool_idle_timeout: number or None
+    @param pool_idle_timeout: Seconds after which an unused pooled cURL
+                              object is closed
+    @type capability_ttl: number or None
+    @param capability_ttl: Seconds after which cached server features and
+                           version are fetched again, C{None} to cache them
+                           until L{InvalidateCapabilities} is called
+    @type request_hooks: list of L{RequestHook}
+    @param request_hooks: Hooks called for every request
+    @type json_codec: L{JsonCodec} or None
+    @param json_codec: Codec for request and response bodies, defaults to the
+                       fastest installed one (see L{GetJsonCodec})
 
     """
     self._username = username
@@ -442,6 +1203,23 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     self._logger = logger
     self._curl_config_fn = curl_config_fn
     self._curl_factory = curl_factory
+    self._request_hooks = list(request_hooks or [])
+
+    if json_codec is None:
+      self._json_codec = GetJsonCodec()
+    else:
+      self._json_codec = json_codec
+
+    if pool_size:
+      self._curl_pool = _CurlPool(self._CreateCurl, pool_size,
+                                  idle_timeout=pool_idle_timeout)
+    else:
+      self._curl_pool = None
+
+    self._capability_ttl = capability_ttl
+    self._capability_lock = threading.Lock()
+    # Dictionary of capability name to (value, time fetched)
+    self._capabilities = {}
 
     try:
       socket.inet_pton(socket.AF_INET6, host)
@@ -495,6 +1273,69 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     return curl
 
+  def Close(self):
+    """Closes all pooled cURL objects and their connections.
+
+    """
+    if self._curl_pool is not None:
+      self._curl_pool.Close()
+
+  def AddRequestHook(self, hook):
+    """Adds a hook called for every request.
+
+    @type hook: L{RequestHook}
+
+    """
+    self._request_hooks.append(hook)
+
+  def RemoveRequestHook(self, hook):
+    """Removes a hook added by L{AddRequestHook}.
+
+    @type hook: L{RequestHook}
+
+    """
+    self._request_hooks.remove(hook)
+
+  def _CallRequestHooks(self, name, trace):
+    """Calls a method of all request hooks, logging their errors.
+
+    """
+    for hook in self._request_hooks:
+      try:
+        getattr(hook, name)(trace)
+      except Exception: # pylint: disable=W0703
+        self._logger.exception("Request hook %r failed", hook)
+
+  def _StartTrace(self, method, path):
+    """Starts tracing a request if there are any request hooks.
+
+    @rtype: L{RequestTrace} or None
+
+    """
+    if not self._request_hooks:
+      return None
+
+    trace = RequestTrace(method, path)
+    self._CallRequestHooks("BeforeRequest", trace)
+    return trace
+
+  def _EndTrace(self, trace, curl, received):
+    """Finishes tracing a request started by L{_StartTrace}.
+
+    @type received: bool
+    @param received: Whether a response was received
+
+    """
+    if trace is None:
+      return
+
+    try:
+      trace._Finish(curl, received) # pylint: disable=W0212
+    except Exception: # pylint: disable=W0703
+      # Hooks still get the partial trace to match their BeforeRequest call
+      self._logger.exception("Failed to record the trace of a request")
+    self._CallRequestHooks("AfterRequest", trace)
+
   @staticmethod
   def _EncodeQuery(query):
     """Encode query values for RAPI URL.
@@ -523,36 +1364,19 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     return result
 
-  def _SendRequest(self, method, path, query, content):
-    """Sends an HTTP request.
-
-    This constructs a full URL, encodes and decodes HTTP bodies, and
-    handles invalid responses in a pythonic way.
-
-    @type method: string
-    @param method: HTTP method to use
-    @type path: string
-    @param path: HTTP URL path
-    @type query: list of two-tuples
-    @param query: query arguments to pass to urlencode
-    @type content: str or None
-    @param content: HTTP body content
-
-    @rtype: str
-    @return: JSON-Decoded response
+  def _PrepareRequest(self, curl, method, path, query, content):
+    """Configures a cURL object for a request.
 
-    @raises CertificateError: If an invalid SSL certificate is found
-    @raises GanetiApiError: If an invalid response is returned
+    @rtype: bytearray
+    @return: Buffer the response body will be written to
 
     """
     assert path.startswith("/")
 
-    curl = self._CreateCurl()
-
     if content is not None:
-      encoded_content = self._json_encoder.encode(content)
+      encoded_content = self._json_codec.Encode(content)
     else:
-      encoded_content = ""
+      encoded_content = b""
 
     # Build URL
     urlparts = [self._base_url, path]
@@ -565,38 +1389,42 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     self._logger.debug("Sending request %s %s (content=%r)",
                        method, url, encoded_content)
 
-    # Buffer for response
-    encoded_resp_body = _CompatIO()
+    # Buffer for response, decoded in place once the transfer finished
+    encoded_resp_body = bytearray()
 
     # Configure cURL
     curl.setopt(pycurl.CUSTOMREQUEST, str(method))
     curl.setopt(pycurl.URL, str(url))
-    curl.setopt(pycurl.POSTFIELDS, str(encoded_content))
-    curl.setopt(pycurl.WRITEFUNCTION, encoded_resp_body.write)
+    curl.setopt(pycurl.POSTFIELDS, encoded_content)
+    curl.setopt(pycurl.WRITEFUNCTION, encoded_resp_body.extend)
 
-    try:
-      # Send request and wait for response
-      try:
-        curl.perform()
-      except pycurl.error as err:
-        if err.args[0] in _CURL_SSL_CERT_ERRORS:
-          raise CertificateError("SSL certificate error %s" % err,
-                                 code=err.args[0])
+    return encoded_resp_body
 
-        raise GanetiApiError(str(err), code=err.args[0])
-    finally:
-      # Reset settings to not keep references to large objects in memory
-      # between requests
-      curl.setopt(pycurl.POSTFIELDS, "")
-      curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
+  def _FinishRequest(self, curl, failed):
+    """Cleans up a cURL object after a request.
+
+    @type failed: bool
+    @param failed: Whether the transfer failed
 
-    # Get HTTP response code
-    http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+    """
+    # Reset settings to not keep references to large objects in memory
+    # between requests
+    curl.setopt(pycurl.POSTFIELDS, "")
+    curl.setopt(pycurl.WRITEFUNCTION, lambda _: None)
 
+    # Don't reuse a cURL object whose connection state is unknown
+    if self._curl_pool is not None:
+      self._curl_pool.Release(curl, discard=failed)
+
+  def _ParseResponse(self, http_code, encoded_resp_body):
+    """Decodes a response and turns HTTP errors into exceptions.
+
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
     # Was anything written to the response buffer?
-    if encoded_resp_body.tell():
-      encoded_resp_body.seek(0)
-      response_content = simplejson.load(encoded_resp_body)
+    if encoded_resp_body:
+      response_content = self._json_codec.Decode(encoded_resp_body)
     else:
       response_content = None
 
@@ -613,6 +1441,58 @@ class GanetiRapiClient(object): # pylint: disable=R0904
 
     return response_content
 
+  def _SendRequest(self, method, path, query, content):
+    """Sends an HTTP request.
+
+    This constructs a full URL, encodes and decodes HTTP bodies, and
+    handles invalid responses in a pythonic way.
+
+    @type method: string
+    @param method: HTTP method to use
+    @type path: string
+    @param path: HTTP URL path
+    @type query: list of two-tuples
+    @param query: query arguments to pass to urlencode
+    @type content: str or None
+    @param content: HTTP body content
+
+    @rtype: str
+    @return: JSON-Decoded response
+
+    @raises CertificateError: If an invalid SSL certificate is found
+    @raises GanetiApiError: If an invalid response is returned
+
+    """
+    trace = self._StartTrace(method, path)
+
+    if self._curl_pool is not None:
+      curl = self._curl_pool.Acquire()
+    else:
+      curl = self._CreateCurl()
+
+    failed = True
+    try:
+      encoded_resp_body = self._PrepareRequest(curl, method, path, query,
+                                               content)
+
+      # Send request and wait for response
+      try:
+        curl.perform()
+      except pycurl.error as err:
+        raise _CurlErrorToApiError(err)
+
+      # Get HTTP response code
+      http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+      failed = False
+    finally:
+      # The cURL object must go back to the pool whatever tracing does
+      try:
+        self._EndTrace(trace, curl, not failed)
+      finally:
+        self._FinishRequest(curl, failed)
+
+    return self._ParseResponse(http_code, encoded_resp_body)
+
   def GetVersion(self):
     """Gets the Remote API version running on the cluster.
 
@@ -628,16 +1508,81 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     @rtype: list
     @return: List of optional features
 
-    """
-    try:
-      return self._SendRequest(HTTP_GET, "/%s/features" % GANETI_RAPI_VERSION,
-                               None, None)
-    except GanetiApiError as err:
-      # Older RAPI servers don't support this resource
-      if err.code == HTTP_NOT_FOUND:
-        return []
+    """
+    try:
+      return self._SendRequest(HTTP_GET, "/%s/features" % GANETI_RAPI_VERSION,
+                               None, None)
+    except GanetiApiError as err:
+      # Older RAPI servers don't support this resource
+      if err.code == HTTP_NOT_FOUND:
+        return []
+
+      raise
+
+  def _GetCapability(self, name, fetch_fn):
+    """Returns a cached server capability, fetching it if necessary.
+
+    @type name: string
+    @param name: Cache key
+    @type fetch_fn: callable
+    @param fetch_fn: Function retrieving the value from the server
+
+    """
+    now = time.time()
+
+    with self._capability_lock:
+      entry = self._capabilities.get(name)
+
+    if entry is not None:
+      (value, fetched) = entry
+      if self._capability_ttl is None or now - fetched < self._capability_ttl:
+        return value
+
+    value = fetch_fn()
+
+    with self._capability_lock:
+      self._capabilities[name] = (value, now)
+
+    return value
+
+  def GetCachedVersion(self):
+    """Gets the Remote API version, using a cached value if available.
+
+    @rtype: int
+    @return: Ganeti Remote API version
+
+    """
+    return self._GetCapability("version", self.GetVersion)
+
+  def GetCachedFeatures(self):
+    """Gets the optional RAPI features, using a cached value if available.
+
+    All methods depending on server features consult this cache.
+
+    @rtype: list
+    @return: List of optional features
+
+    """
+    return self._GetCapability("features", self.GetFeatures)
+
+  def _HasFeature(self, feature):
+    """Checks whether the RAPI server supports an optional feature.
+
+    @type feature: string
+    @param feature: One of the feature strings, e.g. L{INST_CREATE_REQV1}
+    @rtype: bool
+
+    """
+    return feature in self.GetCachedFeatures()
+
+  def InvalidateCapabilities(self):
+    """Forgets cached server features and version.
+
+    Should be called after the RAPI server has been upgraded.
 
-      raise
+    """
+    with self._capability_lock:
+      self._capabilities.clear()
 
   def GetOperatingSystems(self, reason=None):
     """Gets the Operating Systems running in the Ganeti cluster.
@@ -923,7 +1868,7 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     _AppendDryRunIf(query, kwargs.get("dry_run"))
     _AppendReason(query, reason)
 
-    if _INST_CREATE_REQV1 in self.GetFeatures():
+    if self._HasFeature(_INST_CREATE_REQV1):
       body = self.InstanceAllocation(mode, name, disk_template, disks, nics,
                                      **kwargs)
       body[_REQ_DATA_VERSION_FIELD] = 1
@@ -1249,7 +2194,7 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     query = []
     _AppendReason(query, reason)
 
-    if _INST_REINSTALL_REQV1 in self.GetFeatures():
+    if self._HasFeature(_INST_REINSTALL_REQV1):
       body = {
         "start": not no_startup,
         }
@@ -1577,6 +2522,113 @@ class GanetiRapiClient(object): # pylint: disable=R0904
                              "/%s/jobs/%s/wait" % (GANETI_RAPI_VERSION, job_id),
                              None, body)
 
+  def WaitForJob(self, job_id, log_fn=None, min_period=0.5, max_period=10,
+                 _sleep_fn=time.sleep):
+    """Waits for a job to finish.
+
+    Uses L{WaitForJobChange}, which blocks on the server until the job changed,
+    so completion is noticed immediately without polling. Servers not
+    supporting it are polled with an increasing interval instead.
+
+    @type job_id: string
+    @param job_id: job id to watch
+    @type log_fn: callable or None
+    @param log_fn: called with every new job log entry, a list of C{serial},
+                   C{timestamp}, C{type} and C{message}
+    @type min_period: number
+    @param min_period: initial polling interval in seconds when falling back
+                       to polling
+    @type max_period: number
+    @param max_period: maximum polling interval in seconds
+
+    @rtype: dict
+    @return: the finished job's C{status} and C{opresult}
+
+    """
+    state = _JobWaitState(job_id, log_fn, min_period, max_period)
+
+    while True:
+      try:
+        result = self.WaitForJobChange(job_id, _WAIT_JOB_FIELDS,
+                                       state.prev_job_info,
+                                       state.prev_log_serial)
+      except GanetiApiError as err:
+        if err.code not in _WFJC_UNSUPPORTED_CODES:
+          raise
+        self._logger.debug("Server can't wait for job changes (%s), falling"
+                           " back to polling", err)
+        return self._PollJob(state, _sleep_fn)
+
+      job = state.ProcessChange(result)
+      if job is not None:
+        return job
+
+  def _PollJob(self, state, sleep_fn):
+    """Polls a job with an adaptive interval until it is finished.
+
+    @type state: L{_JobWaitState}
+    @see: L{WaitForJob}
+
+    """
+    while True:
+      job = state.ProcessPoll(self.GetJobStatus(state.job_id))
+      if job is not None:
+        return job
+
+      sleep_fn(state.period)
+
+  def _GetJobsStatus(self, job_ids):
+    """Fetches status and result of several jobs with a single request.
+
+    @type job_ids: set of int
+    @param job_ids: job ids to look up
+    @rtype: dict
+    @return: dictionary mapping job ids to dicts with the fields from
+             L{_WAIT_JOB_FIELDS}
+
+    """
+    qfilter = QueryFilterAny("id", sorted(job_ids))
+
+    try:
+      result = self.Query("job", ["id"] + _WAIT_JOB_FIELDS, qfilter=qfilter)
+    except GanetiApiError as err:
+      if err.code not in _QUERY_JOB_UNSUPPORTED_CODES:
+        raise
+      # Older servers can't query jobs, list the whole queue instead
+      return _GetJobsFromList(self.GetJobs(bulk=True), job_ids)
+
+    return _GetJobsFromQuery(result)
+
+  def WaitForJobs(self, job_ids, timeout=None, min_period=0.5, max_period=5,
+                  _sleep_fn=time.sleep, _time_fn=time.time):
+    """Waits for several jobs to finish.
+
+    The status of all unfinished jobs is fetched with one request per round,
+    no matter how many jobs are watched. The polling interval starts at
+    C{min_period} and doubles up to C{max_period} while no job finishes.
+
+    @type job_ids: list
+    @param job_ids: job ids to watch
+    @type timeout: number or None
+    @param timeout: overall number of seconds to wait for all jobs, C{None}
+                    to wait forever
+    @rtype: generator
+    @return: yields C{(job_id, result)} tuples in order of completion, where
+             C{result} is a dict with the job's C{status} and C{opresult}
+
+    @raises GanetiApiError: if a job is unknown
+    @raises JobWaitTimeout: if the timeout expired
+
+    """
+    state = _JobsWaitState(job_ids, timeout, min_period, max_period, _time_fn)
+
+    while state.pending:
+      for finished in state.ProcessStatus(self._GetJobsStatus(state.pending)):
+        yield finished
+
+      if state.pending:
+        _sleep_fn(state.GetSleepPeriod())
+
   def CancelJob(self, job_id, dry_run=False):
     """Cancels a job.
 
@@ -1678,7 +2730,7 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     _AppendDryRunIf(query, dry_run)
     _AppendReason(query, reason)
 
-    if _NODE_EVAC_RES1 in self.GetFeatures():
+    if self._HasFeature(_NODE_EVAC_RES1):
       # Server supports body parameters
       body = {}
 
@@ -1734,7 +2786,7 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     _AppendDryRunIf(query, dry_run)
     _AppendReason(query, reason)
 
-    if _NODE_MIGRATE_REQV1 in self.GetFeatures():
+    if self._HasFeature(_NODE_MIGRATE_REQV1):
       body = {}
 
       _SetItemIf(body, mode is not None, "mode", mode)
@@ -2626,3 +3678,455 @@ class GanetiRapiClient(object): # pylint: disable=R0904
     return self._SendRequest(HTTP_DELETE,
                              ("/%s/filters/%s" % (GANETI_RAPI_VERSION, uuid)),
                              query, body)
+
+
+class _AsyncCurlMulti(object):
+  """Drives cURL transfers from an asyncio event loop.
+
+  Uses C{pycurl.CurlMulti} in socket mode: libcurl reports the sockets and
+  timeouts it is interested in and the event loop calls back into libcurl
+  once any of them is ready, so no thread ever blocks on a transfer.
+
+  """
+  def __init__(self, loop):
+    self._loop = loop
+    self._multi = pycurl.CurlMulti()
+    self._multi.setopt(pycurl.M_SOCKETFUNCTION, self._OnSocket)
+    self._multi.setopt(pycurl.M_TIMERFUNCTION, self._OnTimer)
+    self._timer = None
+    # Dictionary of cURL object to future of the running transfer
+    self._transfers = {}
+
+  def _OnSocket(self, event, fd, multi, data): # pylint: disable=W0613
+    """Called by libcurl to (un)register interest in a socket.
+
+    """
+    if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+      self._loop.add_reader(fd, self._OnAction, fd, pycurl.CSELECT_IN)
+    else:
+      self._loop.remove_reader(fd)
+
+    if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+      self._loop.add_writer(fd, self._OnAction, fd, pycurl.CSELECT_OUT)
+    else:
+      self._loop.remove_writer(fd)
+
+  def _OnTimer(self, timeout_ms):
+    """Called by libcurl to (re)schedule its timeout.
+
+    """
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+
+    if timeout_ms >= 0:
+      self._timer = self._loop.call_later(timeout_ms / 1000.0, self._OnAction,
+                                          pycurl.SOCKET_TIMEOUT, 0)
+
+  def _OnAction(self, fd, ev_bitmask):
+    """Lets libcurl process a socket event or timeout.
+
+    """
+    while True:
+      (ret, _) = self._multi.socket_action(fd, ev_bitmask)
+      if ret != pycurl.E_CALL_MULTI_PERFORM:
+        break
+
+    while True:
+      (queued, ok_list, err_list) = self._multi.info_read()
+
+      for curl in ok_list:
+        self._Complete(curl, None)
+
+      for (curl, errno, errmsg) in err_list:
+        self._Complete(curl, pycurl.error(errno, errmsg))
+
+      if not queued:
+        break
+
+  def _Complete(self, curl, err):
+    """Finishes a transfer.
+
+    """
+    self._multi.remove_handle(curl)
+    future = self._transfers.pop(curl)
+    if not future.done():
+      if err is None:
+        future.set_result(None)
+      else:
+        future.set_exception(err)
+
+  async def Perform(self, curl):
+    """Runs a transfer on a configured cURL object.
+
+    @raises pycurl.error: If the transfer failed
+
+    """
+    future = self._loop.create_future()
+    self._transfers[curl] = future
+    self._multi.add_handle(curl)
+    try:
+      await future
+    finally:
+      if self._transfers.pop(curl, None) is not None:
+        # Cancelled while running
+        self._multi.remove_handle(curl)
+
+  def Close(self):
+    """Releases the multi handle.
+
+    """
+    if self._timer is not None:
+      self._timer.cancel()
+      self._timer = None
+    self._multi.close()
+
+
+class AsyncGanetiRapiClient(GanetiRapiClient): # pylint: disable=R0904
+  """Ganeti RAPI client for asyncio.
+
+  Offers the same methods as L{GanetiRapiClient}, but all methods sending
+  requests are coroutines. Transfers are run through a C{pycurl.CurlMulti}
+  driven by the running event loop, so many requests can be in flight at the
+  same time without using threads. If C{pool_size} is given, it also limits
+  the number of concurrent requests.
+
+  """
+  def __init__(self, *args, **kwargs):
+    """Initializes this class.
+
+    Takes the same arguments as L{GanetiRapiClient}.
+
+    """
+    GanetiRapiClient.__init__(self, *args, **kwargs)
+    self._multi = None
+    self._slots = None
+
+  def _GetMulti(self):
+    """Returns the multi handle, creating it on first use.
+
+    """
+    if self._multi is None:
+      self._multi = _AsyncCurlMulti(asyncio.get_running_loop())
+    return self._multi
+
+  def Close(self):
+    """Closes all pooled cURL objects and the multi handle.
+
+    """
+    if self._multi is not None:
+      self._multi.Close()
+      self._multi = None
+    GanetiRapiClient.Close(self)
+
+  async def _SendRequest(self, method, path, query, content):
+    """Sends an HTTP request.
+
+    @see: L{GanetiRapiClient._SendRequest}
+
+    """
+    trace = self._StartTrace(method, path)
+
+    if self._curl_pool is None:
+      return await self._PerformRequest(self._CreateCurl(), method, path,
+                                        query, content, trace)
+
+    # Never hand out more cURL objects than the pool holds, as a blocking
+    # checkout would stall the event loop
+    if self._slots is None:
+      self._slots = asyncio.Semaphore(self._curl_pool.size)
+
+    async with self._slots:
+      return await self._PerformRequest(self._curl_pool.Acquire(), method,
+                                        path, query, content, trace)
+
+  async def _PerformRequest(self, curl, method, path, query, content, trace):
+    """Runs a request on the given cURL object.
+
+    """
+    failed = True
+    try:
+      encoded_resp_body = self._PrepareRequest(curl, method, path, query,
+                                               content)
+
+      try:
+        await self._GetMulti().Perform(curl)
+      except pycurl.error as err:
+        raise _CurlErrorToApiError(err)
+
+      http_code = curl.getinfo(pycurl.RESPONSE_CODE)
+      failed = False
+    finally:
+      # The cURL object must go back to the pool whatever tracing does
+      try:
+        self._EndTrace(trace, curl, not failed)
+      finally:
+        self._FinishRequest(curl, failed)
+
+    return self._ParseResponse(http_code, encoded_resp_body)
+
+  async def _GetResourceList(self, resource, key, bulk, query):
+    """Lists resources, returning either full details or their ids.
+
+    """
+    result = await self._SendRequest(HTTP_GET,
+                                     "/%s/%s" % (GANETI_RAPI_VERSION, resource),
+                                     query, None)
+    if bulk:
+      return result
+    else:
+      return [item[key] for item in result]
+
+  async def GetFeatures(self):
+    """Gets the list of optional features supported by RAPI server.
+
+    @see: L{GanetiRapiClient.GetFeatures}
+
+    """
+    try:
+      return await self._SendRequest(HTTP_GET,
+                                     "/%s/features" % GANETI_RAPI_VERSION,
+                                     None, None)
+    except GanetiApiError as err:
+      # Older RAPI servers don't support this resource
+      if err.code == HTTP_NOT_FOUND:
+        return []
+
+      raise
+
+  async def _GetCapability(self, name, fetch_fn):
+    """Returns a cached server capability, fetching it if necessary.
+
+    @see: L{GanetiRapiClient._GetCapability}
+
+    """
+    now = time.time()
+
+    entry = self._capabilities.get(name)
+    if entry is not None:
+      (value, fetched) = entry
+      if self._capability_ttl is None or now - fetched < self._capability_ttl:
+        return value
+
+    value = await fetch_fn()
+    self._capabilities[name] = (value, now)
+
+    return value
+
+  def _HasFeature(self, feature):
+    """Checks whether the RAPI server supports an optional feature.
+
+    Callers must have awaited L{GetCachedFeatures} before.
+
+    """
+    return feature in self._capabilities["features"][0]
+
+  async def CreateInstance(self, *args, **kwargs):
+    """Creates a new instance.
+
+    @see: L{GanetiRapiClient.CreateInstance}
+
+    """
+    await self.GetCachedFeatures()
+    return await GanetiRapiClient.CreateInstance(self, *args, **kwargs)
+
+  async def ReinstallInstance(self, *args, **kwargs):
+    """Reinstalls an instance.
+
+    @see: L{GanetiRapiClient.ReinstallInstance}
+
+    """
+    await self.GetCachedFeatures()
+    return await GanetiRapiClient.ReinstallInstance(self, *args, **kwargs)
+
+  async def EvacuateNode(self, *args, **kwargs):
+    """Evacuates instances from a Ganeti node.
+
+    @see: L{GanetiRapiClient.EvacuateNode}
+
+    """
+    await self.GetCachedFeatures()
+    return await GanetiRapiClient.EvacuateNode(self, *args, **kwargs)
+
+  async def MigrateNode(self, *args, **kwargs):
+    """Migrates all primary instances from a node.
+
+    @see: L{GanetiRapiClient.MigrateNode}
+
+    """
+    await self.GetCachedFeatures()
+    return await GanetiRapiClient.MigrateNode(self, *args, **kwargs)
+
+  async def GetInstances(self, bulk=False, reason=None):
+    """Gets information about instances on the cluster.
+
+    @see: L{GanetiRapiClient.GetInstances}
+
+    """
+    query = []
+    _AppendIf(query, bulk, ("bulk", 1))
+    _AppendReason(query, reason)
+
+    return await self._GetResourceList("instances", "id", bulk, query)
+
+  async def GetNodes(self, bulk=False, reason=None):
+    """Gets all nodes in the cluster.
+
+    @see: L{GanetiRapiClient.GetNodes}
+
+    """
+    query = []
+    _AppendIf(query, bulk, ("bulk", 1))
+    _AppendReason(query, reason)
+
+    return await self._GetResourceList("nodes", "id", bulk, query)
+
+  async def GetNetworks(self, bulk=False, reason=None):
+    """Gets all networks in the cluster.
+
+    @see: L{GanetiRapiClient.GetNetworks}
+
+    """
+    query = []
+    _AppendIf(query, bulk, ("bulk", 1))
+    _AppendReason(query, reason)
+
+    return await self._GetResourceList("networks", "name", bulk, query)
+
+  async def GetGroups(self, bulk=False, reason=None):
+    """Gets all node groups in the cluster.
+
+    @see: L{GanetiRapiClient.GetGroups}
+
+    """
+    query = []
+    _AppendIf(query, bulk, ("bulk", 1))
+    _AppendReason(query, reason)
+
+    return await self._GetResourceList("groups", "name", bulk, query)
+
+  async def GetFilters(self, bulk=False):
+    """Gets all filter rules in the cluster.
+
+    @see: L{GanetiRapiClient.GetFilters}
+
+    """
+    query = []
+    _AppendIf(query, bulk, ("bulk", 1))
+
+    return await self._GetResourceList("filters", "uuid", bulk, query)
+
+  async def GetJobs(self, bulk=False):
+    """Gets all jobs for the cluster.
+
+    @see: L{GanetiRapiClient.GetJobs}
+
+    """
+    query = []
+    _AppendIf(query, bulk, ("bulk", 1))
+
+    jobs = await self._GetResourceList("jobs", "id", bulk, query)
+    if bulk:
+      return jobs
+    else:
+      return [int(job_id) for job_id in jobs]
+
+  async def WaitForJobCompletion(self, job_id, period=5, retries=-1):
+    """Polls cluster for job status until completion.
+
+    @see: L{GanetiRapiClient.WaitForJobCompletion}
+    @deprecated: Use L{WaitForJob} instead
+
+    """
+    while retries != 0:
+      job_result = await self.GetJobStatus(job_id)
+
+      if job_result and job_result["status"] == JOB_STATUS_SUCCESS:
+        return True
+      elif not job_result or job_result["status"] in JOB_STATUS_FINALIZED:
+        return False
+
+      if period:
+        await asyncio.sleep(period)
+
+      if retries > 0:
+        retries -= 1
+
+    return False
+
+  async def WaitForJob(self, job_id, log_fn=None, min_period=0.5,
+                       max_period=10, _sleep_fn=asyncio.sleep):
+    """Waits for a job to finish.
+
+    @see: L{GanetiRapiClient.WaitForJob}
+
+    """
+    state = _JobWaitState(job_id, log_fn, min_period, max_period)
+
+    while True:
+      try:
+        result = await self.WaitForJobChange(job_id, _WAIT_JOB_FIELDS,
+                                             state.prev_job_info,
+                                             state.prev_log_serial)
+      except GanetiApiError as err:
+        if err.code not in _WFJC_UNSUPPORTED_CODES:
+          raise
+        self._logger.debug("Server can't wait for job changes (%s), falling"
+                           " back to polling", err)
+        return await self._PollJob(state, _sleep_fn)
+
+      job = state.ProcessChange(result)
+      if job is not None:
+        return job
+
+  async def _PollJob(self, state, sleep_fn):
+    """Polls a job with an adaptive interval until it is finished.
+
+    @see: L{GanetiRapiClient._PollJob}
+
+    """
+    while True:
+      job = state.ProcessPoll(await self.GetJobStatus(state.job_id))
+      if job is not None:
+        return job
+
+      await sleep_fn(state.period)
+
+  async def _GetJobsStatus(self, job_ids):
+    """Fetches status and result of several jobs with a single request.
+
+    @see: L{GanetiRapiClient._GetJobsStatus}
+
+    """
+    qfilter = QueryFilterAny("id", sorted(job_ids))
+
+    try:
+      result = await self.Query("job", ["id"] + _WAIT_JOB_FIELDS,
+                                qfilter=qfilter)
+    except GanetiApiError as err:
+      if err.code not in _QUERY_JOB_UNSUPPORTED_CODES:
+        raise
+      # Older servers can't query jobs, list the whole queue instead
+      return _GetJobsFromList(await self.GetJobs(bulk=True), job_ids)
+
+    return _GetJobsFromQuery(result)
+
+  async def WaitForJobs(self, job_ids, timeout=None, min_period=0.5,
+                        max_period=5, _sleep_fn=asyncio.sleep,
+                        _time_fn=time.time):
+    """Waits for several jobs to finish.
+
+    Use as C{async for (job_id, result) in client.WaitForJobs(...)}.
+
+    @see: L{GanetiRapiClient.WaitForJobs}
+
+    """
+    state = _JobsWaitState(job_ids, timeout, min_period, max_period, _time_fn)
+
+    while state.pending:
+      jobs = await self._GetJobsStatus(state.pending)
+      for finished in state.ProcessStatus(jobs):
+        yield finished
+
+      if state.pending:
+        await _sleep_fn(state.GetSleepPeriod())
@@ -0,0 +1,151 @@
+"""Counters and histograms of the test runner, exported as a textfile.
+
+Every runner process records its own increments and merges them into a state
+file shared by all processes on this host (under a lock, like runs.json).
+The merged values are then rendered to a textfile in the Prometheus/OpenMetrics
+text format, which the node exporter's textfile collector picks up. Counters
+and histograms therefore keep growing across runs, as Prometheus expects.
+"""
+
+import fcntl
+import json
+import os
+import tempfile
+import threading
+
+# Upper bounds of the histogram buckets, in seconds
+PHASE_BUCKETS = (60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 5400, 7200, 10800, 14400, 21600)
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+JOB_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, escape_label_value(value)) for name, value in labels)
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def label_key(labels):
+    # JSON objects need string keys, a sorted list keeps them stable
+    return json.dumps(sorted((labels or {}).items()))
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.definitions = {}
+        # Increments which have not been merged into the state file yet
+        self.pending = {}
+
+    def counter(self, name, help_text):
+        self.definitions[name] = ("counter", help_text, None)
+
+    def histogram(self, name, help_text, buckets):
+        self.definitions[name] = ("histogram", help_text, tuple(buckets))
+
+    def gauge(self, name, help_text):
+        # Gauges describe the current state, they are passed to write() instead
+        self.definitions[name] = ("gauge", help_text, None)
+
+    def inc(self, name, labels=None, value=1):
+        with self.lock:
+            samples = self.pending.setdefault(name, {})
+            key = label_key(labels)
+            samples[key] = samples.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        buckets = self.definitions[name][2]
+        with self.lock:
+            samples = self.pending.setdefault(name, {})
+            key = label_key(labels)
+            sample = samples.setdefault(key, {"buckets": [0] * len(buckets), "sum": 0, "count": 0})
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    sample["buckets"][i] += 1
+            sample["sum"] += value
+            sample["count"] += 1
+
+    def take_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+
+    def restore_pending(self, pending):
+        # Increments which could not be stored are kept for the next write
+        with self.lock:
+            merge_samples(pending, self.pending)
+            self.pending = pending
+
+    def render(self, state, gauges):
+        lines = []
+        for name, (metric_type, help_text, buckets) in sorted(self.definitions.items()):
+            if metric_type == "gauge":
+                samples = gauges.get(name, {})
+            else:
+                samples = state.get(name, {})
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for key, sample in sorted(samples.items()):
+                labels = [tuple(label) for label in json.loads(key)]
+                if metric_type != "histogram":
+                    lines.append("%s%s %s" % (name, format_labels(labels), format_value(sample)))
+                    continue
+                for bound, count in zip(buckets + (float("inf"),), sample["buckets"] + [sample["count"]]):
+                    lines.append("%s_bucket%s %s" % (name, format_labels(labels + [("le", format_value(float(bound)))]),
+                                                     count))
+                lines.append("%s_sum%s %s" % (name, format_labels(labels), format_value(float(sample["sum"]))))
+                lines.append("%s_count%s %s" % (name, format_labels(labels), sample["count"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, state_file, textfile, gauges=None):
+        # gauges maps a gauge name to {label_key(labels): value}
+        with open(state_file + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(state_file) as f:
+                    state = json.load(f)
+            except FileNotFoundError:
+                state = {}
+            pending = self.take_pending()
+            try:
+                merge_samples(state, pending)
+                write_atomically(state_file, json.dumps(state))
+            except Exception:
+                self.restore_pending(pending)
+                raise
+            if textfile is not None:
+                write_atomically(textfile, self.render(state, gauges or {}))
+
+
+def merge_samples(state, pending):
+    for name, samples in pending.items():
+        stored = state.setdefault(name, {})
+        for key, sample in samples.items():
+            if not isinstance(sample, dict):
+                stored[key] = stored.get(key, 0) + sample
+            elif key not in stored or len(stored[key]["buckets"]) != len(sample["buckets"]):
+                # Changed bucket bounds restart the histogram
+                stored[key] = dict(sample, buckets=list(sample["buckets"]))
+            else:
+                for field in ("sum", "count"):
+                    stored[key][field] += sample[field]
+                stored[key]["buckets"] = [a + b for a, b in zip(stored[key]["buckets"], sample["buckets"])]
+
+
+def write_atomically(path, content):
+    # The textfile collector must never read a partially written file
+    temp_file = tempfile.NamedTemporaryFile(mode="w", dir=os.path.dirname(os.path.abspath(path)), delete=False)
+    with temp_file:
+        temp_file.write(content)
+    os.chmod(temp_file.name, 0o644)
+    os.replace(temp_file.name, path)
@@ -1,23 +1,29 @@
 #!/usr/bin/python3
 import argparse
 import atexit
+import concurrent.futures
+import contextlib
 import datetime
+import fcntl
 from datetime import timezone, timedelta
 import hashlib
-import io
 import json
 import os
 import gzip
 import random
+import re
 import selectors
+import shlex
 import shutil
 import socket
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 
 import client as rapi
+import metrics
 
 DOMAIN = "staging.ganeti.org"
 INSTANCE_NAMES = [
@@ -241,10 +247,61 @@ CLUSTER_IP_MIN = 240
 CLUSTER_IP_MAX = 254
 
 STATE_FILE = "%s/runs.json" % (os.path.dirname(os.path.realpath(__file__)))
+# Runs hold their runs.json entry (and with it the cluster IP) through a lease
+# which the running process keeps renewing
+RUN_LEASE_SECONDS = 10 * 60
+RUN_LEASE_RENEW_SECONDS = 60
 STATS_PATH = "/var/lib/ganeti-qa/"
 
 AUTOCLEANUP_MAX_AGE_HOURS = 16
 
+# Header lines printed by the QA suite's RunTest around every test, e.g.
+# "<<<< 2024-01-01 12:00:00.123456 start [TestClusterInit] gnt-cluster init ----"
+QA_TIMESTAMP = r"(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?)"
+QA_TEST_START_RE = re.compile(r"^\S{4} %s start (.+)$" % QA_TIMESTAMP)
+QA_TEST_RESULT_RE = re.compile(r"^\S{4} (PASSED|FAILED) (.+)$")
+QA_TEST_END_RE = re.compile(r"^\S{4} %s time=\S+ (.+)$" % QA_TIMESTAMP)
+QA_TEST_SKIP_RE = re.compile(r"^\S{4} %s skipping (.+?), test\(s\) .* disabled$" % QA_TIMESTAMP)
+QA_HEADER_FILL_RE = re.compile(r"(?: -+)?\s*$")
+ANSI_ESCAPE_RE = re.compile(r"\x1b\[[0-9;]*m")
+
+RUN_CMD_READ_SIZE = 64 * 1024
+RUN_CMD_TAIL_LINES = 50
+RUN_CMD_TAIL_BYTES = 64 * 1024
+
+MATRIX_DEFAULT_PARALLEL = 2
+MATRIX_POLL_INTERVAL_SECONDS = 30
+
+# Node images are exports of an instance set up by IMAGE_PLAYBOOK, one per
+# Debian version, and are rebaked whenever the playbook or its roles change
+IMAGE_FILE = "%s/images.json" % (os.path.dirname(os.path.realpath(__file__)))
+IMAGE_PLAYBOOK = "bake-image"
+IMAGE_ROLES = ["ganeti_build_deps"]
+
+# Warm pool clusters are runs.json entries with a "pool" section; "ready" ones
+# are leased by run-test --from-pool and come back "used" to be reset
+POOL_PLAYBOOK = "warm-cluster"
+
+# Metrics of all runner processes are accumulated in METRICS_STATE_FILE and
+# exported for the node exporter's textfile collector
+METRICS_STATE_FILE = "%s/metrics.json" % (os.path.dirname(os.path.realpath(__file__)))
+METRICS_TEXTFILE = "/var/lib/prometheus/node-exporter/ganeti_qa.prom"
+
+registry = metrics.Registry()
+registry.histogram("ganeti_qa_phase_duration_seconds", "Duration of the phases of a test run",
+                   metrics.PHASE_BUCKETS)
+registry.counter("ganeti_qa_runs_total", "Finished test runs by recipe and result")
+registry.counter("ganeti_qa_rapi_requests_total", "Requests sent to the host cluster's RAPI")
+registry.histogram("ganeti_qa_rapi_request_duration_seconds", "Latency of requests to the host cluster's RAPI",
+                   metrics.REQUEST_BUCKETS)
+registry.histogram("ganeti_qa_job_wait_duration_seconds", "Time from submitting a host cluster job until it finished",
+                   metrics.JOB_BUCKETS)
+registry.counter("ganeti_qa_resource_exhaustion_retries_total",
+                 "Instance creations retried because the host cluster was out of resources")
+registry.gauge("ganeti_qa_active_runs", "Test runs whose process is running")
+registry.gauge("ganeti_qa_pool_clusters", "Warm pool clusters by state")
+metrics_textfile = METRICS_TEXTFILE
+
 def get_random_adjective():
     return random.choice(ADJECTIVES)
 
@@ -253,25 +310,29 @@ def get_random_instance_name():
     return random.choice(INSTANCE_NAMES)
 
 
-def generate_instance_names(amount):
-    names = []
-    for i in range(amount):
-        name_accepted = False
-        break_counter = 0
-        while not name_accepted:
-            break_counter = break_counter + 1
-            if break_counter > 40:
-                raise Exception("Error: no available instance names left. Check unused/dangling instances!")
-
-            name = get_random_instance_name()
-            fqdn = "%s.%s" % (name, DOMAIN)
-
-            if fqdn in names:
-                continue
-
-            if not instance_exists(fqdn):
-                names.append(fqdn)
-                name_accepted = True
+def generate_instance_names(amount, tag, preferred=()):
+    # Names are taken in a fixed order from those neither on the cluster nor
+    # reserved by another run, and are reserved for tag in runs.json
+    candidates = list(preferred) + ["%s.%s" % (name, DOMAIN) for name in INSTANCE_NAMES]
+    result = client.Query("instance", ["name"], rapi.QueryFilterAny("name", candidates))
+    used = set(row[0][1] for row in result["data"])
+
+    with runs_transaction() as runs:
+        for other_tag, run in runs.items():
+            if other_tag != tag:
+                used.update(run.get("instance-names", []))
+        names = []
+        for name in candidates:
+            if name not in used and name not in names:
+                names.append(name)
+        if len(names) < amount:
+            raise Exception("Error: no available instance names left. Check unused/dangling instances!")
+        names = names[:amount]
+
+        if tag not in runs:
+            runs[tag] = {"start-time": datetime.datetime.now().isoformat()}
+            runs[tag].update(new_lease())
+        runs[tag]["instance-names"] = names
     return names
 
 
@@ -284,14 +345,108 @@ def read_stored_runs():
 
 
 def store_runs(runs):
-    with open(STATE_FILE, 'w') as f:
-        json.dump(runs, f)
+    # Readers never see a partially written file
+    temp_file = tempfile.NamedTemporaryFile(mode="w", dir=os.path.dirname(STATE_FILE), delete=False)
+    with temp_file:
+        json.dump(runs, temp_file)
+    os.chmod(temp_file.name, 0o644)
+    os.replace(temp_file.name, STATE_FILE)
+
+
+@contextlib.contextmanager
+def runs_transaction():
+    # All changes to runs.json go through here, the changes are stored when the
+    # block finishes without an exception
+    with open(STATE_FILE + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        runs = read_stored_runs()
+        yield runs
+        store_runs(runs)
+
+
+def new_lease():
+    return {"pid": os.getpid(), "expires": time.time() + RUN_LEASE_SECONDS}
+
+
+def is_lease_expired(run):
+    return run.get("expires") is not None and run["expires"] < time.time()
 
 
-def get_cluster_ip():
+def renew_leases():
+    while True:
+        time.sleep(RUN_LEASE_RENEW_SECONDS)
+        try:
+            with runs_transaction() as runs:
+                for run in runs.values():
+                    if run.get("pid") == os.getpid():
+                        run["expires"] = time.time() + RUN_LEASE_SECONDS
+        except Exception as e:
+            print("Warning: failed to renew the leases in %s: %s" % (STATE_FILE, e))
+
+
+def release_leases():
+    # Entries which outlive the process (e.g. kept instances) are left to the cleanup modes
+    with runs_transaction() as runs:
+        for run in runs.values():
+            if run.get("pid") == os.getpid():
+                run.update({"pid": None, "expires": None})
+
+
+def start_lease_keeper():
+    threading.Thread(target=renew_leases, daemon=True).start()
+    atexit.register(release_leases)
+
+
+def read_images():
+    try:
+        with open(IMAGE_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def store_images(images):
+    temp_file = tempfile.NamedTemporaryFile(mode="w", dir=os.path.dirname(IMAGE_FILE), delete=False)
+    with temp_file:
+        json.dump(images, temp_file)
+    os.chmod(temp_file.name, 0o644)
+    os.replace(temp_file.name, IMAGE_FILE)
+
+
+def get_image_hash():
+    base_dir = os.path.dirname(os.path.realpath(__file__))
+    files = [os.path.join(base_dir, "%s.yml" % IMAGE_PLAYBOOK)]
+    for role in IMAGE_ROLES:
+        for root, dirs, names in os.walk(os.path.join(base_dir, "roles", role)):
+            files.extend(os.path.join(root, name) for name in names)
+
+    digest = hashlib.sha1()
+    for path in sorted(files):
+        digest.update(os.path.relpath(path, base_dir).encode() + b"\0")
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+
+def get_free_cluster_ip_count():
+    ips_in_use = [run.get("cluster-ip") for run in read_stored_runs().values()]
+    return len([i for i in range(CLUSTER_IP_MIN, CLUSTER_IP_MAX) if "192.168.1.%s" % (i) not in ips_in_use])
+
+
+def get_cluster_ip(runs):
+    # Entries of runs which died before creating any instances can be taken over
+    expired = [tag for tag, run in runs.items() if is_lease_expired(run)]
+    if expired:
+        qfilter = rapi.QueryFilterAny("tags", expired, rapi.QueryFilterContains)
+        tags_in_use = set(tag for row in client.Query("instance", ["tags"], qfilter)["data"] for tag in row[0][1])
+        for tag in expired:
+            if tag not in tags_in_use:
+                print("Releasing the expired lease of run '%s'" % tag)
+                del runs[tag]
+
     ips_in_use = []
     for name in runs:
-        ips_in_use.append(runs[name]["cluster-ip"])
+        ips_in_use.append(runs[name].get("cluster-ip"))
 
     for i in range(CLUSTER_IP_MIN, CLUSTER_IP_MAX):
         ip = "192.168.1.%s" % (i)
@@ -364,89 +519,197 @@ def scp_file_to(source_path, dest_path, target_host):
     subprocess.run(cmd, check=True)
 
 
-def scp_folder_from(source_host, source_path, dest_path):
-    cmd = [
-        "/usr/bin/scp",
-        "-q",
-        "-r",
-        "root@%s:%s" % (source_host, source_path),
-        dest_path
+def fetch_folder_from(source_host, source_path, dest_path):
+    # Log files are gzipped on the node and the whole folder is streamed back
+    # as a single tar archive over one ssh session
+    remote_cmd = ("set -e; tmp=$(mktemp -d); trap 'rm -rf \"$tmp\"' EXIT; "
+                  "cp -a %s \"$tmp/\"; find \"$tmp\" -type f -name '*.log' -exec gzip -f {} +; "
+                  "tar -C \"$tmp\" -cf - %s") % (shlex.quote(source_path), shlex.quote(os.path.basename(source_path)))
+    ssh_cmd = [
+        "/usr/bin/ssh",
+        "root@%s" % source_host,
+        remote_cmd
+    ]
+    tar_cmd = [
+        "tar",
+        "-xf",
+        "-",
+        "-C",
+        dest_path,
+        "--strip-components=1"
     ]
 
-    print("Running '%s'" % " ".join(cmd))
+    print("Fetching '%s' from %s" % (source_path, source_host))
 
-    subprocess.run(cmd, check=True)
+    os.makedirs(dest_path, exist_ok=True)
+    ssh = subprocess.Popen(ssh_cmd, stdout=subprocess.PIPE)
+    tar = subprocess.Popen(tar_cmd, stdin=ssh.stdout)
+    ssh.stdout.close()
+    tar.wait()
+    ssh.wait()
+
+    if ssh.returncode != 0 or tar.returncode != 0:
+        raise Exception("ssh exited with code %d, tar with code %d" % (ssh.returncode, tar.returncode))
+
+
+def compress_log_file(log_file_path):
+    gzip_file_path = log_file_path + '.gz'
+
+    with open(log_file_path, 'rb') as f_in:
+        with gzip.open(gzip_file_path, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+    os.remove(log_file_path)
 
 
 def compress_log_files_recursively(directory):
+    log_files = []
     for root, _, files in os.walk(directory):
         for file in files:
             if file.endswith('.log'):
-                log_file_path = os.path.join(root, file)
-                gzip_file_path = log_file_path + '.gz'
+                log_files.append(os.path.join(root, file))
+
+    if log_files:
+        with concurrent.futures.ProcessPoolExecutor() as executor:
+            list(executor.map(compress_log_file, log_files))
+
+
+def collect_logs(instances, stats_directory):
+    def collect(instance):
+        target_dir = stats_directory + '/' + instance
+        try:
+            fetch_folder_from(instance, "/var/log/ganeti", target_dir)
+        except Exception as e:
+            print("Failed to copy log folder from {}: {}".format(instance, e))
+        return target_dir
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(instances)) as executor:
+        target_dirs = list(executor.map(collect, instances))
+
+    # Nodes already send compressed logs, this only catches leftovers
+    for target_dir in target_dirs:
+        try:
+            compress_log_files_recursively(target_dir)
+        except Exception as e:
+            print("Failed to compress log files stored in {}: {}".format(target_dir, e))
+
 
-                with open(log_file_path, 'rb') as f_in:
-                    with gzip.open(gzip_file_path, 'wb') as f_out:
-                        shutil.copyfileobj(f_in, f_out)
+def open_log_file(log_file, compress):
+    if compress:
+        return gzip.open(log_file + ".gz", "wb")
+    return open(log_file, "wb")
 
-                os.remove(log_file_path)
 
-def run_cmd(cmd, log_file):
+def get_stderr_log_file(log_file):
+    base, ext = os.path.splitext(log_file)
+    return "%s.stderr%s" % (base, ext)
+
+
+def run_cmd(cmd, log_file, compress=False, env=None):
     print("Running '%s'" % " ".join(cmd))
+    sys.stdout.flush()
     process = subprocess.Popen(cmd,
-                               bufsize=1,
+                               bufsize=0,
+                               env=env,
                                stdout=subprocess.PIPE,
-                               stderr=subprocess.STDOUT,
-                               universal_newlines=True)
-
-    # Create callback function for process output
-    buf = io.StringIO()
-    def handle_output(stream, mask):
-        # Because the process' output is line buffered, there's only ever one
-        # line to read when this function is called
-        line = stream.readline()
-        buf.write(line)
-        sys.stdout.write(line)
-
-    # Register callback for an "available for read" event from subprocess' stdout stream
-    selector = selectors.DefaultSelector()
-    selector.register(process.stdout, selectors.EVENT_READ, handle_output)
+                               stderr=subprocess.PIPE)
+
+    stdout_fd = process.stdout.fileno()
+    stderr_fd = process.stderr.fileno()
+    stdout_log = open_log_file(log_file, compress)
+    stderr_log_file = get_stderr_log_file(log_file)
+    stderr_log = open_log_file(stderr_log_file, compress)
+
+    # Only the end of the output is kept in memory for the error report,
+    # everything else goes straight to the log files
+    tail = bytearray()
+    stderr_pending = b""
+    stderr_written = False
+
+    def handle_stderr_lines(lines):
+        timestamp = datetime.datetime.now().isoformat().encode()
+        stderr_log.write(b"".join(b"%s %s\n" % (timestamp, line) for line in lines))
+        sys.stderr.buffer.write(b"".join(line + b"\n" for line in lines))
+        sys.stderr.buffer.flush()
+        tail.extend(b"".join(b"[stderr] %s\n" % line for line in lines))
 
-    # Loop until subprocess is terminated
-    while process.poll() is None:
-        # Wait for events and handle them with their registered callbacks
-        events = selector.select()
-        for key, mask in events:
-            callback = key.data
-            callback(key.fileobj, mask)
+    selector = selectors.DefaultSelector()
+    selector.register(stdout_fd, selectors.EVENT_READ)
+    selector.register(stderr_fd, selectors.EVENT_READ)
 
-    # Get process return code
-    return_code = process.wait()
-    selector.close()
+    try:
+        # Loop until both pipes are closed
+        while selector.get_map():
+            stdout_chunks = []
+            for key, _ in selector.select():
+                chunk = os.read(key.fd, RUN_CMD_READ_SIZE)
+                if not chunk:
+                    selector.unregister(key.fd)
+                    if key.fd == stderr_fd and stderr_pending:
+                        handle_stderr_lines([stderr_pending])
+                    continue
+
+                if key.fd == stdout_fd:
+                    stdout_chunks.append(chunk)
+                else:
+                    stderr_written = True
+                    lines = (stderr_pending + chunk).split(b"\n")
+                    stderr_pending = lines.pop()
+                    if lines:
+                        handle_stderr_lines(lines)
+
+            # Write everything read in this round at once
+            if stdout_chunks:
+                data = b"".join(stdout_chunks)
+                stdout_log.write(data)
+                sys.stdout.buffer.write(data)
+                sys.stdout.buffer.flush()
+                tail.extend(data)
+
+            if not compress:
+                # Keep the logs up to date for anyone following them
+                stdout_log.flush()
+                stderr_log.flush()
+
+            if len(tail) > 2 * RUN_CMD_TAIL_BYTES:
+                del tail[:-RUN_CMD_TAIL_BYTES]
+
+        # Get process return code
+        return_code = process.wait()
+    finally:
+        selector.close()
+        process.stdout.close()
+        process.stderr.close()
+        stdout_log.close()
+        stderr_log.close()
+
+    if not stderr_written:
+        os.remove(stderr_log_file + (".gz" if compress else ""))
 
     success = (return_code == 0)
 
-    # Store buffered output
-    output = buf.getvalue()
-    buf.close()
-
-    with open(log_file, "w") as log_file:
-       log_file.write(output)
+    if not success:
+        lines = tail.decode(errors="replace").splitlines()[-RUN_CMD_TAIL_LINES:]
+        print("")
+        print("'%s' failed with exit code %d, last %d lines of output:" % (cmd[0], return_code, len(lines)))
+        print("\n".join(lines))
 
     return success
 
 
-def run_remote_cmd(command, target_host, log_file):
+def run_remote_cmd(command, target_host, log_file, compress=False):
     cmd = [
         "/usr/bin/ssh",
         "root@%s" % target_host,
         command
     ]
-    return run_cmd(cmd, log_file)
+    return run_cmd(cmd, log_file, compress)
 
 
-def run_ansible_playbook(inventory_file, extra_vars, recipe, log_file):
+def run_ansible_playbook(inventory_file, extra_vars, recipe, log_file, timings_file, compress=False):
 
+    # Picked up by callback_plugins/phase_timings.py
+    env = dict(os.environ, GANETI_QA_ANSIBLE_TIMINGS=timings_file)
     cmd = [
         "ansible-playbook",
         "-u",
@@ -458,27 +721,66 @@ def run_ansible_playbook(inventory_file, extra_vars, recipe, log_file):
         "%s.yml" % recipe
     ]
 
-    return run_cmd(cmd, log_file)
+    return run_cmd(cmd, log_file, compress, env)
 
 
-def init_rapi():
-    return rapi.GanetiRapiClient("localhost", port=5080, username="rapi", password="gnt-build-setup")
+class MetricsRequestHook(rapi.RequestHook):
+    def AfterRequest(self, trace):
+        labels = {"method": trace.method, "endpoint": trace.endpoint}
+        registry.observe("ganeti_qa_rapi_request_duration_seconds", trace.duration, labels)
+        registry.inc("ganeti_qa_rapi_requests_total",
+                     dict(labels, code=str(trace.status) if trace.status is not None else "error"))
+
 
+def record_phase(phase, seconds, success):
+    registry.observe("ganeti_qa_phase_duration_seconds", seconds,
+                     {"phase": phase, "result": "success" if success else "failure"})
+    write_metrics()
 
-def instance_exists(name):
+
+def record_job_wait(operation, submitted):
+    registry.observe("ganeti_qa_job_wait_duration_seconds", time.time() - submitted, {"operation": operation})
+
+
+def get_run_gauges(runs):
+    active = 0
+    pool = {}
+    for run in runs.values():
+        if "pool" in run:
+            labels = metrics.label_key({"recipe": run["type"], "os_version": run["pool"]["os-version"],
+                                        "state": run["pool"]["state"]})
+            pool[labels] = pool.get(labels, 0) + 1
+        elif run.get("pid") is not None and not is_lease_expired(run):
+            active += 1
+    return {"ganeti_qa_active_runs": {metrics.label_key(None): active}, "ganeti_qa_pool_clusters": pool}
+
+
+def write_metrics():
+    textfile = metrics_textfile
+    if textfile is not None and not os.path.isdir(os.path.dirname(textfile)):
+        textfile = None
     try:
-        client.GetInstance(name)
-    except rapi.GanetiApiError as e:
-        if e.code == 404:
-            return False
-        else:
-            raise
-    return True
+        registry.write(METRICS_STATE_FILE, textfile, get_run_gauges(read_stored_runs()))
+    except Exception as e:
+        print("Warning: failed to write the metrics to %s: %s" % (METRICS_STATE_FILE, e))
+
+
+def init_rapi():
+    return rapi.GanetiRapiClient("localhost", port=5080, username="rapi", password="gnt-build-setup", pool_size=4,
+                                 request_hooks=[MetricsRequestHook()])
 
 
-def create_instance(name, os_type, tag, recipe):
+def wait_for_job(job_id, action, operation):
+    submitted = time.time()
+    job = client.WaitForJob(job_id)
+    record_job_wait(operation, submitted)
+    if job["status"] != rapi.JOB_STATUS_SUCCESS:
+        raise Exception("Failed to %s: %s" % (action, job["opresult"]))
+    return job
+
+
+def get_instance_params(name, os_type, tag, recipe, image=None):
     params = {
-        '__version__': 1,
         'beparams': {
             'memory': "6G",
             'minmem': "6G",
@@ -501,7 +803,6 @@ def create_instance(name, os_type, tag, recipe):
             }
         ],
         'hypervisor': "kvm",
-        'iallocator': "hail",
         'name': name,
         'os_type': "debootstrap+" + os_type,
         'mode': 'create',
@@ -513,18 +814,196 @@ def create_instance(name, os_type, tag, recipe):
         ],
     }
     if "fake" in recipe:
-        print("(with reduced disk/memory footprint due to fake hypervisor recipe)... ", end="")
         params["beparams"]["memory"] = "3G"
         params["beparams"]["minmem"] = "3G"
         params["beparams"]["maxmem"] = "3G"
-    job_id = client.CreateInstance(**params)
-    if not client.WaitForJobCompletion(job_id, period=1):
-        job = client.GetJobStatus(job_id)
-        raise Exception("Failed to create instance %s: %s" % (name, job["opresult"]))
+    if image is not None:
+        # Relative export paths are looked up in the export directory of src_node
+        params["mode"] = "import"
+        params["src_node"] = image["node"]
+        params["src_path"] = image["name"]
+    return params
+
+
+def parse_size(size):
+    # Ganeti sizes are given in MiB unless they carry a unit suffix
+    units = {"M": 1, "G": 1024, "T": 1024 * 1024}
+    size = str(size)
+    if size[-1].upper() in units:
+        return int(float(size[:-1]) * units[size[-1].upper()])
+    return int(size)
+
+
+def get_instance_footprint(recipe):
+    params = get_instance_params("", "", "", recipe)
+    memory = parse_size(params["beparams"]["memory"])
+    disk = sum(parse_size(disk["size"]) for disk in params["disks"])
+    return memory, disk
+
+
+def get_free_instance_slots(recipe):
+    memory, disk = get_instance_footprint(recipe)
+    result = client.Query("node", ["mfree", "dfree", "offline", "drained"])
+    slots = 0
+    for data in result["data"]:
+        mfree, dfree, offline, drained = [value for _, value in data]
+        if offline or drained or mfree is None or dfree is None:
+            continue
+        slots += min(mfree // memory, dfree // disk)
+    return slots
+
+
+def get_capacity_freeing_jobs():
+    qfilter = rapi.QueryFilterAny("status", sorted(rapi.JOB_STATUS_PENDING | {rapi.JOB_STATUS_RUNNING}))
+    result = client.Query("job", ["id", "summary"], qfilter=qfilter)
+    job_ids = []
+    for data in result["data"]:
+        if any(op.startswith(CAPACITY_FREEING_OPS) for op in data[1][1] or []):
+            job_ids.append(data[0][1])
+    return job_ids
+
+
+def wait_for_capacity_change(timeout):
+    # Instead of sleeping blindly, wake up as soon as a job which frees
+    # resources (e.g. another run's teardown) has finished, returns whether one did
+    job_ids = get_capacity_freeing_jobs()
+    if not job_ids:
+        time.sleep(timeout)
+        return False
+    try:
+        next(client.WaitForJobs(job_ids, timeout=timeout))
+        return True
+    except rapi.JobWaitTimeout:
+        return False
+
+
+def get_retry_backoff(attempt):
+    # 30s, 1m, 2m, 4m, then 5m between failed attempts
+    if attempt == 0:
+        return 0
+    return min(CAPACITY_POLL_INTERVAL_SECONDS * 2 ** (attempt - 1), CAPACITY_RETRY_MAX_BACKOFF_SECONDS)
+
+
+def wait_for_capacity(recipe, timeout, backoff=0):
+    # The free slot estimate is only trusted once a job freeing capacity has
+    # finished or backoff seconds have passed
+    deadline = time.time() + timeout
+    retry_at = time.time() + backoff
+    announced = False
+    while True:
+        if time.time() >= retry_at and get_free_instance_slots(recipe) >= 3:
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        if not announced:
+            print("Waiting for the host cluster to free up resources (up to %.1f hours remaining)..." % (remaining / 3600))
+            announced = True
+        if wait_for_capacity_change(min(remaining, max(retry_at - time.time(), CAPACITY_POLL_INTERVAL_SECONDS))):
+            retry_at = time.time()
+
+
+def get_job_submit_times(job_ids):
+    # For jobs submitted by another job (e.g. a multi-allocation), the RAPI
+    # on this host received them before their ids were known here
+    now = time.time()
+    job_ids = [int(job_id) for job_id in job_ids]
+    result = client.Query("job", ["id", "received_ts"], rapi.QueryFilterAny("id", job_ids))
+    received = dict((row[0][1], row[1][1][0] + row[1][1][1] / 1e6) for row in result["data"] if row[1][1])
+    return dict((job_id, received.get(job_id, now)) for job_id in job_ids)
+
+
+def create_instances(names, os_type, tag, recipe, image=None):
+    # A single multi-allocation lets hail place all nodes at once, instances it
+    # cannot fit are listed in allocation_failed while the others are created
+    allocations = [client.InstanceAllocation(**get_instance_params(name, os_type, tag, recipe, image))
+                   for name in names]
+    job = wait_for_job(client.InstancesMultiAlloc(allocations, iallocator="hail"),
+                       "allocate instances %s" % ", ".join(names), "multialloc")
+
+    job_ids = []
+    errors = []
+    failed = job["opresult"][0].get("allocation_failed", [])
+    if failed:
+        # Reported as resource exhaustion, so the created instances are removed and the allocation retried
+        errors.append("not enough resources to allocate %s" % ", ".join(failed))
+    for success, result in job["opresult"][0]["jobs"]:
+        if success:
+            job_ids.append(result)
+        else:
+            errors.append(str(result))
+
+    submitted = get_job_submit_times(job_ids)
+    for job_id, create_job in client.WaitForJobs(job_ids):
+        record_job_wait("create", submitted[job_id])
+        if create_job["status"] != rapi.JOB_STATUS_SUCCESS:
+            errors.append(str(create_job["opresult"]))
+
+    if errors:
+        raise Exception("Failed to create instances %s: %s" % (", ".join(names), "; ".join(errors)))
+
+
+def bake_image(os_version, image_hash, log_file):
+    # Reusing an earlier name overwrites its export instead of leaving it behind
+    previous = read_images().get(os_version)
+    tag = "image-%s-%s" % (os_version, image_hash)
+    name = generate_instance_names(1, tag, get_image_export_names(previous))[0]
+
+    print("Baking node image %s for %s on %s... " % (image_hash, os_version, name))
+    try:
+        create_instances([name], os_version, tag, "")
+        node = client.GetInstance(name)["pnode"]
+        inventory_file = tempfile.NamedTemporaryFile(mode="w", delete=False)
+        inventory_file.write("[ganeti_nodes]\n%s\n" % name)
+        inventory_file.close()
+        cmd = ["ansible-playbook", "-u", "root", "-i", inventory_file.name, "%s.yml" % IMAGE_PLAYBOOK]
+        if not run_cmd(cmd, log_file):
+            raise Exception("Failed to set up the image instance %s, see %s" % (name, log_file))
+
+        wait_for_job(client.ExportInstance(name, "local", node, shutdown=True, remove_instance=True),
+                     "export instance %s" % name, "export")
+    except Exception:
+        remove_instances_by_tag(tag)
+        raise
+    finally:
+        with runs_transaction() as runs:
+            runs.pop(tag, None)
+
+    return {"name": name, "node": node, "hash": image_hash, "created": datetime.datetime.now().isoformat()}
+
+
+def get_image_export_names(image):
+    if image is None:
+        return []
+    return [image["name"]] + image.get("stale-exports", [])
+
+
+def ensure_image(os_version, log_file):
+    # Concurrent runs wait for a single bake of the same image
+    with open(IMAGE_FILE + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        image_hash = get_image_hash()
+        image = read_images().get(os_version)
+        if image is not None and image["hash"] == image_hash:
+            return image
+
+        image = bake_image(os_version, image_hash, log_file)
+        images = read_images()
+        # Exports which could not be overwritten stay listed, a later bake reuses their names
+        image["stale-exports"] = [name for name in get_image_export_names(images.get(os_version))
+                                  if name != image["name"]]
+        images[os_version] = image
+        store_images(images)
+        return image
 
 
 INSTANCE_CREATE_MAX_WAIT_SECONDS = 5 * 60 * 60
-INSTANCE_CREATE_RETRY_INTERVAL_SECONDS = 5 * 60
+CAPACITY_POLL_INTERVAL_SECONDS = 30
+CAPACITY_RETRY_MAX_BACKOFF_SECONDS = 5 * 60
+# Operations whose completion may leave room for new instances
+CAPACITY_FREEING_OPS = ("INSTANCE_REMOVE", "INSTANCE_SHUTDOWN", "NODE_ADD")
+# Upper bound of shutdown/remove jobs queued at once during a teardown
+TEARDOWN_MAX_PARALLEL_JOBS = 12
 
 
 def is_resource_exhaustion_error(error_msg):
@@ -537,23 +1016,64 @@ def is_resource_exhaustion_error(error_msg):
     return any(indicator in error_str for indicator in resource_indicators)
 
 
+def run_instance_jobs(instances, submit_fn, action, operation, errors):
+    # Keeps up to TEARDOWN_MAX_PARALLEL_JOBS jobs running and returns the
+    # instances whose job succeeded, failures are added to errors
+    queue = list(instances)
+    running = {}
+    succeeded = []
+    while queue or running:
+        while queue and len(running) < TEARDOWN_MAX_PARALLEL_JOBS:
+            instance = queue.pop(0)
+            try:
+                running[int(submit_fn(instance))] = (instance, time.time())
+            except rapi.GanetiApiError as e:
+                errors[instance] = "failed to %s: %s" % (action, e)
+        # Refill the queue as soon as one job finished
+        for job_id, job in client.WaitForJobs(list(running)):
+            instance, submitted = running.pop(job_id)
+            record_job_wait(operation, submitted)
+            if job["status"] == rapi.JOB_STATUS_SUCCESS:
+                succeeded.append(instance)
+            else:
+                errors[instance] = "failed to %s: %s" % (action, job["opresult"])
+            if queue:
+                break
+    return succeeded
+
+
+def remove_instances_by_tags(tags):
+    # Returns the tags which are still on some instance afterwards
+    qfilter = rapi.QueryFilterAny("tags", tags, rapi.QueryFilterContains)
+    instance_tags = dict((row[0][1], row[1][1]) for row in client.Query("instance", ["name", "tags"], qfilter)["data"])
+    instances = sorted(instance_tags)
+    if not instances:
+        return set()
+
+    # All shutdowns first, so the deletes do not wait behind them in the job queue
+    teardown_start = time.time()
+    errors = {}
+    print("Shutting down %d instance(s)..." % len(instances))
+    stopped = run_instance_jobs(instances, lambda instance: client.ShutdownInstance(instance, timeout=0),
+                                "shut down", "shutdown", errors)
+    print("Removing %d instance(s)..." % len(stopped))
+    run_instance_jobs(stopped, client.DeleteInstance, "remove", "remove", errors)
+
+    for instance, error in sorted(errors.items()):
+        print("Error: %s: %s" % (instance, error))
+    record_phase("teardown", time.time() - teardown_start, not errors)
+    return set(tag for instance in errors for tag in instance_tags[instance] if tag in tags)
+
+
 def remove_instances_by_tag(tag):
-    result = client.Query("instance", ["name", "tags"])
-    for data in result["data"]:
-        if tag in data[1][1]:
-            instance = data[0][1]
-            job_id = client.ShutdownInstance(instance, timeout=0)
-            if not client.WaitForJobCompletion(job_id, period=1):
-                job = client.GetJobStatus(job_id)
-                raise Exception("Failed to shutdown instance %s: %s" % (instance, job["opresult"]))
-            job_id = client.DeleteInstance(instance)
-            if not client.WaitForJobCompletion(job_id, period=1):
-                job = client.GetJobStatus(job_id)
-                raise Exception("Failed to remove instance %s: %s" % (instance, job["opresult"]))
-
-
-def get_instances_by_tag():
-    result = client.Query("instance", ["name", "tags"])
+    if remove_instances_by_tags([tag]):
+        raise Exception("Failed to remove all instances tagged '%s'" % tag)
+
+
+def get_instances_by_tag(tags=None):
+    # Only the instances carrying one of the given tags cross the wire
+    qfilter = None if tags is None else rapi.QueryFilterAny("tags", tags, rapi.QueryFilterContains)
+    result = client.Query("instance", ["name", "tags"], qfilter)
     instances = {}
     for data in result["data"]:
         if len(data[1][1]) == 1:
@@ -568,6 +1088,73 @@ def get_instances_by_tag():
     return instances
 
 
+def parse_qa_timestamp(timestamp):
+    return datetime.datetime.fromisoformat(timestamp)
+
+
+def extract_qa_test_timings(log_file):
+    opener = gzip.open if log_file.endswith(".gz") else open
+    tests = []
+    running = []
+
+    # The log is read line by line, it can be several hundred megabytes
+    with opener(log_file, "rt", errors="replace") as f:
+        for line in f:
+            line = QA_HEADER_FILL_RE.sub("", ANSI_ESCAPE_RE.sub("", line))
+
+            match = QA_TEST_START_RE.match(line)
+            if match:
+                running.append({"name": match.group(2), "start": match.group(1), "result": "unknown"})
+                continue
+
+            match = QA_TEST_RESULT_RE.match(line)
+            if match and running:
+                # Tests can be nested, a result always belongs to the innermost one
+                running[-1]["result"] = "passed" if match.group(1) == "PASSED" else "failed"
+                continue
+
+            match = QA_TEST_END_RE.match(line)
+            if match:
+                for i in reversed(range(len(running))):
+                    if running[i]["name"] == match.group(2):
+                        test = running.pop(i)
+                        break
+                else:
+                    continue
+                test["end"] = match.group(1)
+                test["duration"] = (parse_qa_timestamp(test["end"]) - parse_qa_timestamp(test["start"])).total_seconds()
+                tests.append(test)
+                continue
+
+            match = QA_TEST_SKIP_RE.match(line)
+            if match:
+                tests.append({"name": match.group(2), "start": match.group(1), "end": match.group(1),
+                              "duration": 0, "result": "skipped"})
+
+    # Tests which never finished, e.g. because the QA suite was aborted
+    for test in running:
+        test.update({"end": None, "duration": None, "result": "aborted"})
+        tests.append(test)
+
+    tests.sort(key=lambda test: test["start"])
+    return tests
+
+
+def print_role_timings(timings_file):
+    try:
+        with open(timings_file) as f:
+            roles = json.load(f)['roles']
+    except (OSError, ValueError, KeyError):
+        return
+    for role, seconds in sorted(roles.items(), key=lambda item: item[1], reverse=True):
+        print("  {}: {}".format(role, timedelta(seconds=round(seconds))))
+
+
+def store_test_timings(directory, tests):
+    with open(directory + '/tests.json', 'w') as f:
+        json.dump({'tests': tests}, f)
+
+
 def store_stats(directory, tag, recipe, os_version, source, branch, instances, state, started_ts, instance_create_runtime, playbook_runtime, qa_runtime, overall_runtime):
     data = {
         'started': started_ts,
@@ -600,18 +1187,219 @@ def create_stats_directory(args):
 
 
 def cleanup(tag):
-    remove_instances_by_tag(tag)
-    runs = read_stored_runs()
-    del runs[tag]
-    store_runs(runs)
+    pool_tag = read_stored_runs().get(tag, {}).get("pool-cluster")
+    if pool_tag is not None:
+        return_pool_cluster(pool_tag)
+    else:
+        remove_instances_by_tag(tag)
+    with runs_transaction() as runs:
+        runs.pop(tag, None)
+
+
+def get_pool_clusters(runs, recipe, os_version, state):
+    return [(tag, run) for tag, run in runs.items()
+            if "pool" in run and run["type"] == recipe and run["pool"]["os-version"] == os_version
+            and run["pool"]["state"] == state]
+
+
+def update_pool_cluster(cluster, state, leased_by=None):
+    # start-time is what auto-cleanup looks at, so it restarts with every state
+    cluster["start-time"] = datetime.datetime.now().isoformat()
+    cluster["pool"].update({"state": state, "leased-by": leased_by})
+    # Only warming clusters belong to a process, the others are idle or owned by their run
+    cluster.update(new_lease() if state == "warming" else {"pid": None, "expires": None})
+
+
+def set_pool_state(pool_tag, state, leased_by=None):
+    with runs_transaction() as runs:
+        update_pool_cluster(runs[pool_tag], state, leased_by)
+
+
+def is_cluster_healthy(instances):
+    result = client.Query("instance", ["name", "oper_state"], rapi.QueryFilterAny("name", instances))
+    running = set(row[0][1] for row in result["data"] if row[1][1])
+    return running.issuperset(instances)
+
+
+def destroy_pool_cluster(pool_tag):
+    print("Removing warm cluster %s" % pool_tag)
+    remove_instances_by_tag(pool_tag)
+    with runs_transaction() as runs:
+        runs.pop(pool_tag, None)
+
+
+def lease_pool_cluster(recipe, os_version, tag):
+    while True:
+        with runs_transaction() as runs:
+            ready = get_pool_clusters(runs, recipe, os_version, "ready")
+            if not ready:
+                return None, None
+            pool_tag, cluster = ready[0]
+            update_pool_cluster(cluster, "leased", leased_by=tag)
+        if is_cluster_healthy(cluster["instance-names"]):
+            return pool_tag, cluster
+        destroy_pool_cluster(pool_tag)
+
+
+def return_pool_cluster(pool_tag):
+    cluster = read_stored_runs().get(pool_tag)
+    if cluster is None:
+        return
+    if is_cluster_healthy(cluster["instance-names"]):
+        print("Returning warm cluster %s to the pool, it is reset by the next fill-pool" % pool_tag)
+        set_pool_state(pool_tag, "used")
+    else:
+        destroy_pool_cluster(pool_tag)
+
+
+def warm_pool_cluster(instances, log_file):
+    inventory_file = store_inventory(instances)
+    cmd = ["ansible-playbook", "-u", "root", "-i", inventory_file, "%s.yml" % POOL_PLAYBOOK]
+    if not run_cmd(cmd, log_file):
+        raise Exception("Failed to prepare the nodes %s, see %s" % (", ".join(instances), log_file))
+
+
+def reset_pool_cluster(instances, log_file):
+    # Reinstalling gives every node a fresh root disk with the original OS
+    submitted = time.time()
+    job_ids = [client.ReinstallInstance(name) for name in instances]
+    for job_id, job in client.WaitForJobs(job_ids):
+        record_job_wait("reinstall", submitted)
+        if job["status"] != rapi.JOB_STATUS_SUCCESS:
+            raise Exception("Failed to reinstall (job %s): %s" % (job_id, job["opresult"]))
+    warm_pool_cluster(instances, log_file)
+
+
+def fill_pool(recipe, os_version, size, use_image, log_dir):
+    while True:
+        with runs_transaction() as runs:
+            used = get_pool_clusters(runs, recipe, os_version, "used")
+            if not used:
+                break
+            pool_tag, cluster = used[0]
+            update_pool_cluster(cluster, "warming")
+
+        print("Resetting warm cluster %s... " % pool_tag)
+        try:
+            reset_pool_cluster(cluster["instance-names"], os.path.join(log_dir, "%s.log" % pool_tag))
+        except Exception as e:
+            print("Failed to reset warm cluster %s: %s" % (pool_tag, e))
+            destroy_pool_cluster(pool_tag)
+            continue
+        set_pool_state(pool_tag, "ready")
+
+    missing = size - len(get_pool_clusters(read_stored_runs(), recipe, os_version, "ready"))
+    image = ensure_image(os_version, os.path.join(log_dir, "image.log")) if use_image and missing > 0 else None
+    for i in range(missing):
+        pool_tag = "pool-%s-%s" % (get_random_adjective(), get_random_instance_name())
+        with runs_transaction() as runs:
+            if pool_tag in runs:
+                continue
+            runs[pool_tag] = {
+                "cluster-ip": get_cluster_ip(runs),
+                "type": recipe,
+                "start-time": datetime.datetime.now().isoformat(),
+                "pool": {"os-version": os_version, "state": "warming", "leased-by": None},
+            }
+            runs[pool_tag].update(new_lease())
+
+        try:
+            instances = generate_instance_names(3, pool_tag)
+            print("Creating warm cluster %s from %s... " % (pool_tag, ", ".join(instances)))
+            if not wait_for_capacity(recipe, INSTANCE_CREATE_MAX_WAIT_SECONDS):
+                raise Exception("not enough resources on the host cluster")
+            create_instances(instances, os_version, pool_tag, recipe, image)
+            warm_pool_cluster(instances, os.path.join(log_dir, "%s.log" % pool_tag))
+        except Exception as e:
+            print("Failed to create warm cluster %s: %s" % (pool_tag, e))
+            destroy_pool_cluster(pool_tag)
+            break
+        set_pool_state(pool_tag, "ready")
+
+
+def read_matrix(matrix_file, args):
+    with open(matrix_file) as f:
+        entries = json.load(f)
+
+    matrix = []
+    for entry in entries:
+        if not os.path.exists("%s.yml" % entry["recipe"]):
+            raise Exception("Error: matrix entry uses unknown recipe '%s'" % entry["recipe"])
+        matrix.append({
+            "recipe": entry["recipe"],
+            "os-version": entry["os-version"],
+            "source": entry.get("source", args.source),
+            "branch": entry.get("branch", args.branch),
+        })
+    return matrix
+
+
+def generate_tag(tags_in_use):
+    while True:
+        tag = "%s-%s" % (get_random_adjective(), get_random_instance_name())
+        if tag not in tags_in_use:
+            return tag
+
+
+def can_start_matrix_run(recipe, running):
+    # Runs which have not stored their cluster IP yet still need one
+    stored_runs = read_stored_runs()
+    unregistered = [tag for tag in running if tag not in stored_runs]
+    if get_free_cluster_ip_count() <= len(unregistered):
+        return False
+
+    # Leave room for the instances of runs which are still being created
+    instances = get_instances_by_tag(list(running))
+    pending_instances = sum(max(0, 3 - len(instances.get(tag, []))) for tag in running)
+    return get_free_instance_slots(recipe) >= pending_instances + 3
+
+
+def run_matrix(matrix, parallel, extra_args, log_dir):
+    queue = list(matrix)
+    running = {}
+    results = []
+
+    while queue or running:
+        for tag, (process, entry, log_file) in list(running.items()):
+            if process.poll() is not None:
+                log_file.close()
+                del running[tag]
+                results.append((entry, tag, process.returncode))
+                print("Run '%s' (%s on %s from %s:%s) exited with code %d" % (
+                    tag, entry["recipe"], entry["os-version"], entry["source"], entry["branch"], process.returncode))
+
+        while queue and len(running) < parallel and can_start_matrix_run(queue[0]["recipe"], running):
+            entry = queue.pop(0)
+            tag = generate_tag(set(read_stored_runs()) | set(running))
+            cmd = [
+                sys.executable,
+                "-u",
+                os.path.realpath(__file__),
+                "run-test",
+                "--tag", tag,
+                "--recipe", entry["recipe"],
+                "--os-version", entry["os-version"],
+                "--source", entry["source"],
+                "--branch", entry["branch"],
+            ] + extra_args
+            log_file = open(os.path.join(log_dir, "%s.log" % tag), "w")
+            print("Starting run '%s': %s" % (tag, " ".join(cmd)))
+            process = subprocess.Popen(cmd, stdout=log_file, stderr=subprocess.STDOUT)
+            running[tag] = (process, entry, log_file)
+
+        if queue or running:
+            time.sleep(MATRIX_POLL_INTERVAL_SECONDS)
+
+    return results
 
 
 def main():
-    global client
+    global client, metrics_textfile
     client = init_rapi()
 
     parser = argparse.ArgumentParser(description="Manage Ganeti Cluster testing environments")
-    parser.add_argument('mode', choices=["remove-tests", "run-test", "list-tests", "auto-cleanup"])
+    parser.add_argument('mode', choices=["remove-tests", "run-test", "run-matrix", "list-tests", "auto-cleanup",
+                                         "bake-image", "fill-pool"])
     parser.add_argument('--source', default="ganeti/ganeti")
     parser.add_argument('--branch', default="master")
     parser.add_argument('--os-version', default=None)
@@ -620,8 +1408,24 @@ def main():
     parser.add_argument('--remove-instances-on-success', action='store_true', default=False)
     parser.add_argument('--remove-instances-on-error', action='store_true', default=False)
     parser.add_argument('--build-only', action='store_true', default=False)
+    parser.add_argument('--compress-logs', action='store_true', default=False)
+    parser.add_argument('--no-build-cache', action='store_true', default=False)
+    parser.add_argument('--use-image', action='store_true', default=False)
+    parser.add_argument('--from-pool', action='store_true', default=False)
+    parser.add_argument('--pool-size', type=int, default=1)
+    parser.add_argument('--matrix', default=None)
+    parser.add_argument('--parallel', type=int, default=MATRIX_DEFAULT_PARALLEL)
+    parser.add_argument('--metrics-textfile', default=METRICS_TEXTFILE)
+    parser.add_argument('--rapi-summary', action='store_true', default=False)
 
     args = parser.parse_args()
+    metrics_textfile = args.metrics_textfile or None
+    atexit.register(write_metrics)
+    if args.rapi_summary:
+        # Shows whether RAPI time goes to TLS, to the server or to the transfer
+        aggregator = rapi.RequestStatsAggregator()
+        aggregator.DumpAtExit(sys.stdout)
+        client.AddRequestHook(aggregator)
 
     # parameter validation
     if args.mode == "run-test":
@@ -636,27 +1440,49 @@ def main():
                 print("Error: the given recipe does not seem to exist (make sure there is an Ansible playbook with "
                       "the same name in this directory)")
                 sys.exit(1)
+    elif args.mode == "fill-pool":
+        if args.os_version is None or args.recipe is None:
+            print("Error: please specify the OS version and the recipe of the warm clusters")
+            sys.exit(1)
+        if args.pool_size < 0:
+            print("Error: --pool-size must not be negative")
+            sys.exit(1)
+    elif args.mode == "bake-image":
+        if args.os_version is None:
+            print("Error: please specify the OS version (e.g. bookworm) to bake a node image for")
+            sys.exit(1)
     elif args.mode == "remove-tests":
         if args.tag is None:
             print("Error: Please specify a valid tag for 'remove-tests' mode")
             sys.exit(1)
+    elif args.mode == "run-matrix":
+        if args.matrix is None:
+            print("Error: please specify a JSON file listing the recipe/os-version/source/branch combinations to run")
+            sys.exit(1)
+        if args.parallel < 1:
+            print("Error: --parallel must be at least 1")
+            sys.exit(1)
 
-    global runs
-    runs = read_stored_runs()
-    cluster_ip = get_cluster_ip()
+    if args.mode in ("run-test", "fill-pool", "bake-image"):
+        start_lease_keeper()
 
     # operational logic
     if args.mode == "run-test":
-        tag = "%s-%s" % (get_random_adjective(), get_random_instance_name())
+        if args.tag is not None:
+            tag = args.tag
+        else:
+            tag = "%s-%s" % (get_random_adjective(), get_random_instance_name())
         if args.remove_instances_on_error:
             atexit.register(cleanup, tag)
         print("Using tag '%s' for this session" % tag)
-        runs[tag] = {
-            "cluster-ip": cluster_ip,
-            "type": args.recipe,
-            "start-time": datetime.datetime.now().isoformat()
-        }
-        store_runs(runs)
+        with runs_transaction() as runs:
+            cluster_ip = get_cluster_ip(runs)
+            runs[tag] = {
+                "cluster-ip": cluster_ip,
+                "type": args.recipe,
+                "start-time": datetime.datetime.now().isoformat()
+            }
+            runs[tag].update(new_lease())
 
 
         stats_directory = create_stats_directory(args)
@@ -668,53 +1494,84 @@ def main():
         if not args.build_only:
             store_stats(stats_directory, tag, args.recipe, args.os_version, args.source, args.branch, [], 'running', started_ts, 0, 0, 0, 0)
 
+        pool_tag = None
+        if args.from_pool:
+            pool_tag, pool_cluster = lease_pool_cluster(args.recipe, args.os_version, tag)
+            if pool_tag is None:
+                print("No warm cluster ready for %s on %s, creating new instances" % (args.recipe, args.os_version))
+            else:
+                print("Leased warm cluster %s" % pool_tag)
+                cluster_ip = pool_cluster["cluster-ip"]
+                with runs_transaction() as runs:
+                    runs[tag].update({"cluster-ip": cluster_ip, "pool-cluster": pool_tag})
+
+        image = None
+        if args.use_image and pool_tag is None:
+            try:
+                image = ensure_image(args.os_version, stats_directory + '/image.log')
+            except Exception as e:
+                print("Failed to prepare the node image, installing the instances from scratch: %s" % e)
+
         instances_start = datetime.datetime.now()
-        instances = generate_instance_names(3)
+        if pool_tag is not None:
+            instances = pool_cluster["instance-names"]
+        else:
+            instances = generate_instance_names(3, tag)
         attempt = 0
-        while True:
-            created_this_attempt = []
+        # A leased warm cluster already has its instances
+        while pool_tag is None:
+            # After a failed attempt wait for the cluster to change or back off,
+            # otherwise hail would most likely fail the same way again
+            remaining = INSTANCE_CREATE_MAX_WAIT_SECONDS - (datetime.datetime.now() - instances_start).total_seconds()
+            if not wait_for_capacity(args.recipe, remaining, backoff=get_retry_backoff(attempt)):
+                print("\nResource exhaustion persists after 5 hours. Giving up.")
+                record_phase("instance-create", (datetime.datetime.now() - instances_start).total_seconds(), False)
+                registry.inc("ganeti_qa_runs_total", {"recipe": args.recipe, "result": "failed"})
+                state = "failed"
+                store_stats(stats_directory, tag, args.recipe, args.os_version, args.source, args.branch, instances, state, started_ts, 0, 0, 0, 0)
+                sys.exit(1)
             try:
-                for instance in instances:
-                    print("Creating instance %s... " % instance, end="")
-                    create_instance(instance, args.os_version, tag, args.recipe)
-                    created_this_attempt.append(instance)
-                    print("done.")
+                print("Creating instances %s... " % ", ".join(instances), end="")
+                if "fake" in args.recipe:
+                    print("(with reduced disk/memory footprint due to fake hypervisor recipe)... ", end="")
+                create_instances(instances, args.os_version, tag, args.recipe, image)
+                print("done.")
                 break
             except Exception as e:
                 if is_resource_exhaustion_error(e):
-                    elapsed = (datetime.datetime.now() - instances_start).total_seconds()
-                    remaining = INSTANCE_CREATE_MAX_WAIT_SECONDS - elapsed
-                    if remaining <= 0:
-                        print("\nResource exhaustion persists after 5 hours. Giving up.")
-                        state = "failed"
-                        store_stats(stats_directory, tag, args.recipe, args.os_version, args.source, args.branch, instances, state, started_ts, 0, 0, 0, 0)
-                        sys.exit(1)
-                    if created_this_attempt:
-                        print("\nCleaning up %d partially created instance(s) before retry..." % len(created_this_attempt))
-                        try:
-                            remove_instances_by_tag(tag)
-                        except Exception as cleanup_err:
-                            print("Warning: cleanup failed: %s" % cleanup_err)
+                    print("\nCleaning up partially created instances before retry...")
+                    try:
+                        remove_instances_by_tag(tag)
+                    except Exception as cleanup_err:
+                        print("Warning: cleanup failed: %s" % cleanup_err)
                     attempt += 1
-                    sleep_secs = min(INSTANCE_CREATE_RETRY_INTERVAL_SECONDS, remaining)
-                    print("\nNot enough resources (attempt %d). Retrying in %.0f minutes (up to %.1f hours remaining)..." % (
-                        attempt, sleep_secs / 60, remaining / 3600))
-                    time.sleep(sleep_secs)
+                    registry.inc("ganeti_qa_resource_exhaustion_retries_total", {"recipe": args.recipe})
+                    print("Not enough resources (attempt %d). Retrying once a job freed capacity or after %d seconds..."
+                          % (attempt, get_retry_backoff(attempt)))
                 else:
+                    record_phase("instance-create", (datetime.datetime.now() - instances_start).total_seconds(), False)
+                    registry.inc("ganeti_qa_runs_total", {"recipe": args.recipe, "result": "failed"})
                     state = "failed"
                     store_stats(stats_directory, tag, args.recipe, args.os_version, args.source, args.branch, instances, state, started_ts, 0, 0, 0, 0)
                     sys.exit(1)
         instances_end = datetime.datetime.now()
         instances_diff = instances_end - instances_start
+        if pool_tag is None:
+            record_phase("instance-create", instances_diff.total_seconds(), True)
 
         inventory_file = store_inventory(instances)
         extra_vars = "ganeti_source=%s ganeti_branch=%s ganeti_cluster_ip=%s" % (args.source, args.branch, cluster_ip)
+        if args.no_build_cache:
+            extra_vars += " ganeti_build_cache=false"
         playbook_start = datetime.datetime.now()
-        success = run_ansible_playbook(inventory_file, extra_vars, args.recipe, stats_directory + '/playbook.log')
+        success = run_ansible_playbook(inventory_file, extra_vars, args.recipe, stats_directory + '/playbook.log',
+                                       stats_directory + '/playbook-timings.json', args.compress_logs)
         playbook_end = datetime.datetime.now()
         playbook_diff = playbook_end - playbook_start
+        record_phase("playbook", playbook_diff.total_seconds(), success)
 
         if not success:
+            registry.inc("ganeti_qa_runs_total", {"recipe": args.recipe, "result": "failed"})
             state = "failed"
             store_stats(stats_directory, tag, args.recipe, args.os_version, args.source, args.branch, instances, state, started_ts, instances_diff.total_seconds(), playbook_diff.total_seconds(), 0, instances_diff.total_seconds() + playbook_diff.total_seconds())
             if args.remove_instances_on_error:
@@ -722,6 +1579,7 @@ def main():
             sys.exit(1)
 
         if args.build_only:
+            registry.inc("ganeti_qa_runs_total", {"recipe": args.recipe, "result": "built"})
             print("Finished setting up the cluster, but --build-only was given. Exiting now!")
             sys.exit()
 
@@ -731,8 +1589,16 @@ def main():
 
         qa_command = "export PYTHONPATH=\"/usr/src/ganeti:/usr/share/ganeti/default\"; cd /usr/src/ganeti/qa; python3 -u ganeti-qa.py --yes-do-it /tmp/recipe.json"
         qa_start = datetime.datetime.now()
-        success = run_remote_cmd(qa_command, instances[0], stats_directory + '/qa.log')
+        success = run_remote_cmd(qa_command, instances[0], stats_directory + '/qa.log', args.compress_logs)
         qa_end = datetime.datetime.now()
+        record_phase("qa", (qa_end - qa_start).total_seconds(), success)
+        registry.inc("ganeti_qa_runs_total", {"recipe": args.recipe, "result": "finished" if success else "failed"})
+
+        try:
+            qa_log_file = stats_directory + '/qa.log' + ('.gz' if args.compress_logs else '')
+            store_test_timings(stats_directory, extract_qa_test_timings(qa_log_file))
+        except Exception as e:
+            print("Failed to extract QA test timings: {}".format(e))
 
         if success:
             state = 'finished'
@@ -744,17 +1610,9 @@ def main():
 
         store_stats(stats_directory, tag, args.recipe, args.os_version, args.source, args.branch, instances, state, started_ts, instances_diff.total_seconds(), playbook_diff.total_seconds(), qa_diff.total_seconds(), overall_runtime.total_seconds())
 
-        for instance in instances:
-            target_dir = stats_directory + '/' + instance
-            os.mkdir
-            try:
-                scp_folder_from(instance, "/var/log/ganeti", target_dir)
-            except Exception as e:
-                print("Failed to copy log folder from {}: {}".format(instance, e))
-            try:
-                compress_log_files_recursively(target_dir)
-            except Exception as e:
-                print("Failed to compress log files stored in {}: {}".format(target_dir, e))
+        collect_start = time.time()
+        collect_logs(instances, stats_directory)
+        record_phase("log-collection", time.time() - collect_start, True)
 
         fix_permissions(stats_directory)
 
@@ -762,40 +1620,83 @@ def main():
             print("")
             print("QA finished successfully - removing test instances")
             print("")
-            remove_instances_by_tag(tag)
-            runs = read_stored_runs()
-            del runs[tag]
-            store_runs(runs)
+            cleanup(tag)
 
         if not success and args.remove_instances_on_error:
             print("")
             print("QA failed - removing test instances as requested")
             print("")
-            remove_instances_by_tag(tag)
-            runs = read_stored_runs()
-            del runs[tag]
-            store_runs(runs)
+            cleanup(tag)
 
         print("Instance Creation Runtime: {}".format(instances_diff))
         print("Setup/Playbook Runtime: {}".format(playbook_diff))
+        print_role_timings(stats_directory + '/playbook-timings.json')
         print("QA Suite Runtime: {}".format(qa_diff))
         print("")
         print("Overall Runtime: {}".format(overall_runtime))
 
+    elif args.mode == "run-matrix":
+        matrix = read_matrix(args.matrix, args)
+        extra_args = []
+        if args.remove_instances_on_success:
+            extra_args.append("--remove-instances-on-success")
+        if args.remove_instances_on_error:
+            extra_args.append("--remove-instances-on-error")
+        if args.compress_logs:
+            extra_args.append("--compress-logs")
+        if args.no_build_cache:
+            extra_args.append("--no-build-cache")
+        if args.use_image:
+            extra_args.append("--use-image")
+        if args.from_pool:
+            extra_args.append("--from-pool")
+        log_dir = tempfile.mkdtemp(prefix="ganeti-qa-matrix-")
+        print("Running %d test(s) with up to %d in parallel, logs are stored in %s" % (len(matrix), args.parallel, log_dir))
+
+        results = run_matrix(matrix, args.parallel, extra_args, log_dir)
+
+        print("")
+        failed = 0
+        for entry, tag, return_code in results:
+            print("%s: %s on %s from %s:%s - %s" % (
+                tag, entry["recipe"], entry["os-version"], entry["source"], entry["branch"],
+                "success" if return_code == 0 else "failed"))
+            if return_code != 0:
+                failed += 1
+        if failed:
+            sys.exit(1)
+
     elif args.mode == "remove-tests":
         print("Removing all instances from the cluster with the tag '%s'" % args.tag)
         try:
-            remove_instances_by_tag(args.tag)
+            # Runs on a warm cluster hand it back to the pool instead
+            pool_tag = read_stored_runs().get(args.tag, {}).get("pool-cluster")
+            if pool_tag is not None:
+                return_pool_cluster(pool_tag)
+            else:
+                remove_instances_by_tag(args.tag)
         finally:
-            runs = read_stored_runs()
-            if args.tag in runs:
-                del runs[args.tag]
-                store_runs(runs)
+            with runs_transaction() as runs:
+                runs.pop(args.tag, None)
 
     elif args.mode == "list-tests":
         print("Listing all instances grouped by tag")
         print(get_instances_by_tag())
 
+    elif args.mode == "fill-pool":
+        log_dir = tempfile.mkdtemp(prefix="ganeti-qa-pool-")
+        print("Filling the pool of %s clusters on %s up to %d, logs are stored in %s" % (
+            args.recipe, args.os_version, args.pool_size, log_dir))
+        fill_pool(args.recipe, args.os_version, args.pool_size, args.use_image, log_dir)
+        for pool_tag, cluster in get_pool_clusters(read_stored_runs(), args.recipe, args.os_version, "ready"):
+            print("%s: %s (cluster IP %s)" % (pool_tag, ", ".join(cluster["instance-names"]), cluster["cluster-ip"]))
+
+    elif args.mode == "bake-image":
+        log_file = tempfile.NamedTemporaryFile(prefix="ganeti-qa-image-", suffix=".log", delete=False).name
+        image = ensure_image(args.os_version, log_file)
+        print("Node image for %s: export %s on %s (version %s, baked %s)" % (
+            args.os_version, image["name"], image["node"], image["hash"], image["created"]))
+
     elif args.mode == "auto-cleanup":
 
         print("Removing all tests which have been started > %dh ago" % AUTOCLEANUP_MAX_AGE_HOURS)
@@ -803,16 +1704,31 @@ def main():
         current_time = datetime.datetime.now()
         cleanup_list = []
         for tag, run in runs.items():
+            # Idle warm clusters are kept, leased ones go back with the run that leased them
+            pool = run.get("pool", {})
+            if pool.get("state") == "ready" or (pool.get("state") == "leased" and pool["leased-by"] in runs):
+                continue
             if "start-time" in run:
                 start_time = datetime.datetime.fromisoformat(run["start-time"])
                 time_difference = current_time - start_time
                 if time_difference > timedelta(hours=AUTOCLEANUP_MAX_AGE_HOURS):
-                    print("Cleaning up run '%s'" % tag)
-                    remove_instances_by_tag(tag)
                     cleanup_list.append(tag)
+        # Runs on warm clusters return them to the pool, all others are torn
+        # down together
+        teardown_list = []
         for tag in cleanup_list:
-            del runs[tag]
-        store_runs(runs)
+            print("Cleaning up run '%s'" % tag)
+            if "pool-cluster" in runs[tag]:
+                cleanup(tag)
+            else:
+                teardown_list.append(tag)
+        if teardown_list:
+            # Runs with leftover instances are retried the next time
+            failed = remove_instances_by_tags(teardown_list)
+            with runs_transaction() as runs:
+                for tag in teardown_list:
+                    if tag not in failed:
+                        runs.pop(tag, None)
 
 
 if __name__ == "__main__":
@@ -1,13 +1,44 @@
 #!/usr/bin/env python3
 
 import os
+import csv
 import json
 import datetime
 from datetime import timezone
+import hashlib
+import math
+import sqlite3
 import time
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 
 WEB_PATH = "/var/lib/ganeti-qa/"
+INDEX_DB = os.path.join(WEB_PATH, "runs-index.sqlite")
+
+# Archive pages are filled starting with the oldest run, so a full page never
+# changes again unless one of its runs is updated
+RUNS_PER_PAGE = 100
+
+API_PATH = os.path.join(WEB_PATH, "api")
+LATEST_RUNS = 50
+AGGREGATE_DIMENSIONS = {
+    "recipe": "$.recipe",
+    "source-branch": "$.\"source-branch\"",
+    "os-version": "$.\"os-version\"",
+}
+AGGREGATE_RUNTIMES = ["instance-create", "playbook", "qa"]
+
+# Per-run page with the setup and QA timings, rendered into the run's directory
+TIMINGS_PAGE = "timings.html"
+SLOWEST_TASKS = 25
+
+# A QA test counts as slower if it took noticeably longer than the median of
+# the same test in the previous runs of the same recipe
+TEST_BASELINE_RUNS = 10
+TEST_BASELINE_MIN_RUNS = 3
+TEST_SLOWDOWN_FACTOR = 1.25
+TEST_SLOWDOWN_MIN_SECONDS = 30
+# The relative slowdown of near-instant tests is computed against this baseline
+TEST_BASELINE_MIN_SECONDS = 1
 
 STATE_IMAGES = {
     "running": "progress.svg",
@@ -20,39 +51,306 @@ def fmt_duration(seconds):
     return time.strftime("%H:%M:%S", time.gmtime(seconds)) if seconds > 0 else "—"
 
 
+def open_index():
+    db = sqlite3.connect(INDEX_DB)
+    db.execute("CREATE TABLE IF NOT EXISTS runs ("
+               "id TEXT PRIMARY KEY, mtime REAL NOT NULL, started REAL NOT NULL, "
+               "state TEXT NOT NULL, data TEXT NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS runs_started ON runs (started)")
+    db.execute("CREATE TABLE IF NOT EXISTS pages (file TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+    db.execute("CREATE TABLE IF NOT EXISTS exports (name TEXT PRIMARY KEY, digest TEXT NOT NULL)")
+    db.execute("CREATE TABLE IF NOT EXISTS tests ("
+               "run_id TEXT NOT NULL, position INTEGER NOT NULL, name TEXT NOT NULL, "
+               "duration REAL, result TEXT NOT NULL, PRIMARY KEY (run_id, position))")
+    return db
+
+
+def index_tests(db, run_id, run_dir):
+    db.execute("DELETE FROM tests WHERE run_id = ?", (run_id,))
+    try:
+        with open(os.path.join(run_dir, "tests.json")) as f:
+            tests = json.load(f)["tests"]
+    except (FileNotFoundError, ValueError):
+        return
+    db.executemany("INSERT INTO tests (run_id, position, name, duration, result) VALUES (?, ?, ?, ?, ?)",
+                   [(run_id, i, test["name"], test["duration"], test["result"]) for i, test in enumerate(tests)])
+
+
+def update_index(db):
+    # Returns the ids of the runs which were added or changed
+    indexed = dict(db.execute("SELECT id, mtime FROM runs"))
+    seen = set()
+    changed = []
+
+    for entry in os.scandir(WEB_PATH):
+        if not entry.is_dir():
+            continue
+        run_path = os.path.join(entry.path, "run.json")
+        try:
+            mtime = os.stat(run_path).st_mtime
+        except FileNotFoundError:
+            continue
+        seen.add(entry.name)
+        if indexed.get(entry.name) == mtime:
+            continue
+
+        try:
+            with open(run_path) as f:
+                run = json.load(f)
+        except ValueError:
+            # The runner is just writing this file, pick it up next time
+            continue
+        db.execute("INSERT OR REPLACE INTO runs (id, mtime, started, state, data) VALUES (?, ?, ?, ?, ?)",
+                   (entry.name, mtime, run["started"], run["state"], json.dumps(run)))
+        # The runner writes tests.json before the final run.json
+        index_tests(db, entry.name, entry.path)
+        changed.append(entry.name)
+
+    removed = set(indexed) - seen
+    db.executemany("DELETE FROM runs WHERE id = ?", [(run_id,) for run_id in removed])
+    db.executemany("DELETE FROM tests WHERE run_id = ?", [(run_id,) for run_id in removed])
+    db.commit()
+    return changed
+
+
+def to_template_row(run_id, run):
+    start_ts = datetime.datetime.fromtimestamp(run["started"], timezone.utc)
+    return {
+        "started": start_ts.strftime("%Y-%m-%d %H:%M:%S UTC"),
+        "started_unix": int(run["started"]),
+        "state": run["state"],
+        "tag": run.get("tag", "n/a"),
+        "state_image": STATE_IMAGES.get(run["state"], "blah"),
+        "os_version": run["os-version"],
+        "source_repository": run["source-repository"],
+        "source_branch": run["source-branch"],
+        "recipe": run["recipe"],
+        "log_folder_link": "/{}".format(run_id),
+        "timings_link": ("/{}/{}".format(run_id, TIMINGS_PAGE)
+                         if os.path.exists(os.path.join(WEB_PATH, run_id, TIMINGS_PAGE)) else None),
+        "duration": fmt_duration(run["runtimes"]["overall"]),
+        "instance_create_duration": fmt_duration(run["runtimes"]["instance-create"]),
+        "playbook_duration": fmt_duration(run["runtimes"]["playbook"]),
+        "qa_duration": fmt_duration(run["runtimes"].get("qa", 0)),
+    }
+
+
+def render_page(template, file_name, rows, now, **kwargs):
+    # rows are (id, mtime, data) tuples, oldest first
+    runs = [to_template_row(run_id, json.loads(data)) for run_id, _, data in reversed(rows)]
+    html = template.render(runs=runs, now=now, current=file_name, **kwargs)
+    with open(os.path.join(WEB_PATH, file_name), "w") as f:
+        f.write(html)
+
+
+def share(seconds, longest):
+    return round(100 * (seconds or 0) / longest, 1) if longest else 0
+
+
+def render_run_page(template, db, run_id, now):
+    run_dir = os.path.join(WEB_PATH, run_id)
+    try:
+        with open(os.path.join(run_dir, "playbook-timings.json")) as f:
+            playbook = json.load(f)
+    except (FileNotFoundError, ValueError):
+        playbook = {"roles": {}, "tasks": []}
+    tests = db.execute("SELECT name, duration, result FROM tests WHERE run_id = ? ORDER BY position",
+                       (run_id,)).fetchall()
+    if not playbook["tasks"] and not tests:
+        return
+
+    task_counts = {}
+    for task in playbook["tasks"]:
+        role = task["role"] or "(playbook)"
+        task_counts[role] = task_counts.get(role, 0) + 1
+    longest_role = max(playbook["roles"].values(), default=0)
+    roles = [{"name": name, "tasks": task_counts.get(name, 0), "duration": fmt_duration(seconds),
+              "share": share(seconds, longest_role)}
+             for name, seconds in sorted(playbook["roles"].items(), key=lambda item: item[1], reverse=True)]
+
+    slowest = sorted(playbook["tasks"], key=lambda task: task["duration"] or 0, reverse=True)[:SLOWEST_TASKS]
+    longest_task = slowest[0]["duration"] if slowest else 0
+    tasks = [{"role": task["role"] or "", "task": task["task"], "action": task["action"],
+              "duration": fmt_duration(task["duration"] or 0), "share": share(task["duration"], longest_task)}
+             for task in slowest]
+
+    longest_test = max((duration or 0 for _, duration, _ in tests), default=0)
+    tests = [{"name": name, "result": result, "duration": fmt_duration(duration or 0),
+              "share": share(duration, longest_test)}
+             for name, duration, result in tests]
+
+    (data,) = db.execute("SELECT data FROM runs WHERE id = ?", (run_id,)).fetchone()
+    html = template.render(run=to_template_row(run_id, json.loads(data)), roles=roles, tasks=tasks, tests=tests,
+                           now=now)
+    with open(os.path.join(run_dir, TIMINGS_PAGE), "w") as f:
+        f.write(html)
+
+
+def page_digest(rows, **nav):
+    digest = hashlib.sha1(json.dumps(nav, sort_keys=True).encode())
+    for run_id, mtime, _ in rows:
+        digest.update(("%s:%r\n" % (run_id, mtime)).encode())
+    return digest.hexdigest()
+
+
+def render_archive(db, template, rows, now):
+    page_count = len(rows) // RUNS_PER_PAGE
+    archive_pages = []
+
+    for number in range(1, page_count + 1):
+        file_name = "page-%04d.html" % number
+        page_rows = rows[(number - 1) * RUNS_PER_PAGE:number * RUNS_PER_PAGE]
+        title = "Runs {}–{}".format((number - 1) * RUNS_PER_PAGE + 1, number * RUNS_PER_PAGE)
+        archive_pages.append({"number": number, "file": file_name, "title": title})
+
+        nav = {
+            "subtitle": "Ganeti QA test runs, archive page {} ({})".format(number, title.lower()),
+            "older_page": "page-%04d.html" % (number - 1) if number > 1 else None,
+            "newer_page": "page-%04d.html" % (number + 1) if number < page_count else "index.html",
+        }
+        digest = page_digest(page_rows, **nav)
+        stored = db.execute("SELECT digest FROM pages WHERE file = ?", (file_name,)).fetchone()
+        if stored and stored[0] == digest and os.path.exists(os.path.join(WEB_PATH, file_name)):
+            continue
+
+        render_page(template, file_name, page_rows, now, **nav)
+        db.execute("INSERT OR REPLACE INTO pages (file, digest) VALUES (?, ?)", (file_name, digest))
+
+    db.commit()
+    return archive_pages
+
+
+def percentile(sorted_values, p):
+    # Nearest-rank percentile
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(p / 100 * len(sorted_values)) - 1)]
+
+
+def aggregate(db, json_path):
+    groups = {}
+    rows = db.execute("SELECT json_extract(data, ?), state, json_extract(data, '$.runtimes') FROM runs",
+                      (json_path,))
+    for value, state, runtimes in rows:
+        group = groups.setdefault(value, {"runs": 0, "finished": 0, "failed": 0, "running": 0,
+                                          "values": {name: [] for name in AGGREGATE_RUNTIMES}})
+        group["runs"] += 1
+        group[state] = group.get(state, 0) + 1
+        # Failed runs stop early, their partial runtimes would skew the percentiles
+        if state != "finished":
+            continue
+        runtimes = json.loads(runtimes)
+        for name in AGGREGATE_RUNTIMES:
+            if runtimes.get(name, 0) > 0:
+                group["values"][name].append(runtimes[name])
+
+    result = {}
+    for value, group in groups.items():
+        completed = group["finished"] + group["failed"]
+        runtimes = {}
+        for name, values in group.pop("values").items():
+            values.sort()
+            runtimes[name] = {"p50": percentile(values, 50), "p90": percentile(values, 90)}
+        group["pass-rate"] = group["finished"] / completed if completed else None
+        group["runtimes"] = runtimes
+        result[value] = group
+    return result
+
+
+def get_test_durations(db, run_id):
+    # Tests may run several times per run (e.g. once per disk template)
+    return dict(db.execute("SELECT name, SUM(duration) FROM tests WHERE run_id = ? AND result = 'passed' "
+                           "GROUP BY name", (run_id,)))
+
+
+def find_slower_tests(db):
+    slower_tests = []
+    recipes = [recipe for (recipe,) in db.execute("SELECT DISTINCT json_extract(data, '$.recipe') FROM runs")]
+    for recipe in recipes:
+        run_ids = [run_id for (run_id,) in db.execute(
+            "SELECT id FROM runs WHERE json_extract(data, '$.recipe') = ? AND state != 'running' "
+            "AND id IN (SELECT run_id FROM tests) ORDER BY started DESC LIMIT ?",
+            (recipe, TEST_BASELINE_RUNS + 1))]
+        if len(run_ids) <= TEST_BASELINE_MIN_RUNS:
+            continue
+
+        latest_run_id = run_ids[0]
+        baseline = {}
+        for run_id in run_ids[1:]:
+            for name, duration in get_test_durations(db, run_id).items():
+                baseline.setdefault(name, []).append(duration)
+
+        for name, duration in get_test_durations(db, latest_run_id).items():
+            values = sorted(baseline.get(name, []))
+            if len(values) < TEST_BASELINE_MIN_RUNS:
+                continue
+            median = percentile(values, 50)
+            if duration > median * TEST_SLOWDOWN_FACTOR and duration - median >= TEST_SLOWDOWN_MIN_SECONDS:
+                slower_tests.append({
+                    "recipe": recipe,
+                    "test": name,
+                    "run-id": latest_run_id,
+                    "duration": duration,
+                    "baseline": median,
+                    "baseline-runs": len(values),
+                })
+
+    slower_tests.sort(key=lambda test: test["duration"] - test["baseline"], reverse=True)
+    return slower_tests
+
+
+def write_atomically(file_name, write_fn):
+    tmp_file = file_name + ".tmp"
+    with open(tmp_file, "w", newline="") as f:
+        write_fn(f)
+    os.replace(tmp_file, file_name)
+
+
+def write_aggregates(db, rows, slower_tests):
+    # Only recompute when a run changed since the last time
+    digest = page_digest(rows)
+    stored = db.execute("SELECT digest FROM exports WHERE name = 'api'").fetchone()
+    if stored and stored[0] == digest and os.path.exists(os.path.join(API_PATH, "summary.json")):
+        return
+
+    os.makedirs(API_PATH, exist_ok=True)
+    summary = {
+        "generated": datetime.datetime.now(timezone.utc).isoformat(),
+        "runs": len(rows),
+    }
+    for dimension, json_path in AGGREGATE_DIMENSIONS.items():
+        summary["by-" + dimension] = aggregate(db, json_path)
+
+    write_atomically(os.path.join(API_PATH, "summary.json"), lambda f: json.dump(summary, f, indent=1))
+
+    def write_csv(f):
+        writer = csv.writer(f)
+        header = ["dimension", "value", "runs", "finished", "failed", "running", "pass-rate"]
+        for name in AGGREGATE_RUNTIMES:
+            header += ["%s-p50" % name, "%s-p90" % name]
+        writer.writerow(header)
+        for dimension in AGGREGATE_DIMENSIONS:
+            for value, group in sorted(summary["by-" + dimension].items(), key=lambda item: str(item[0])):
+                row = [dimension, value, group["runs"], group["finished"], group["failed"], group["running"],
+                       group["pass-rate"]]
+                for name in AGGREGATE_RUNTIMES:
+                    row += [group["runtimes"][name]["p50"], group["runtimes"][name]["p90"]]
+                writer.writerow(row)
+
+    write_atomically(os.path.join(API_PATH, "summary.csv"), write_csv)
+
+    latest = [dict(json.loads(data), id=run_id) for run_id, _, data in reversed(rows[-LATEST_RUNS:])]
+    write_atomically(os.path.join(API_PATH, "latest-runs.json"), lambda f: json.dump(latest, f, indent=1))
+
+    write_atomically(os.path.join(API_PATH, "slower-tests.json"), lambda f: json.dump(slower_tests, f, indent=1))
+
+    db.execute("INSERT OR REPLACE INTO exports (name, digest) VALUES ('api', ?)", (digest,))
+    db.commit()
+
+
 def main():
-    ganeti_runs = []
-    for entry in os.listdir(WEB_PATH):
-        run_dir = os.path.join(WEB_PATH, entry)
-        if os.path.isdir(run_dir):
-            run_id = os.path.basename(run_dir)
-            run_path = os.path.join(run_dir, "run.json")
-            if os.path.exists(run_path):
-                with open(run_path) as f:
-                    ganeti_runs.append(json.load(f))
-                    ganeti_runs[-1]["id"] = run_id
-
-    ganeti_runs.sort(reverse=True, key=lambda x: x["started"])
-
-    template_data = []
-    for run in ganeti_runs:
-        start_ts = datetime.datetime.fromtimestamp(run["started"], timezone.utc)
-        template_data.append({
-            "started": start_ts.strftime("%Y-%m-%d %H:%M:%S UTC"),
-            "started_unix": int(run["started"]),
-            "state": run["state"],
-            "tag": run.get("tag", "n/a"),
-            "state_image": STATE_IMAGES.get(run["state"], "blah"),
-            "os_version": run["os-version"],
-            "source_repository": run["source-repository"],
-            "source_branch": run["source-branch"],
-            "recipe": run["recipe"],
-            "log_folder_link": "/{}".format(run["id"]),
-            "duration": fmt_duration(run["runtimes"]["overall"]),
-            "instance_create_duration": fmt_duration(run["runtimes"]["instance-create"]),
-            "playbook_duration": fmt_duration(run["runtimes"]["playbook"]),
-            "qa_duration": fmt_duration(run["runtimes"].get("qa", 0)),
-        })
+    db = open_index()
+    changed = update_index(db)
 
     env = Environment(
         loader=FileSystemLoader(os.path.dirname(os.path.realpath(__file__))),
@@ -61,9 +359,34 @@ def main():
     template = env.get_template("index.html.j2")
     now = datetime.datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S UTC")
 
-    index_html = template.render(runs=template_data, now=now)
-    with open(os.path.join(WEB_PATH, "index.html"), "w") as f:
-        f.write(index_html)
+    # Before the listings, which link to the run pages that exist
+    run_template = env.get_template("run.html.j2")
+    for run_id in changed:
+        render_run_page(run_template, db, run_id, now)
+
+    rows = db.execute("SELECT id, mtime, data FROM runs ORDER BY started, id").fetchall()
+    archive_pages = render_archive(db, template, rows, now)
+    slower_tests = find_slower_tests(db)
+    write_aggregates(db, rows, slower_tests)
+
+    latest = rows[-RUNS_PER_PAGE:]
+    older_page = None
+    if archive_pages:
+        older_page = archive_pages[-1]["file"]
+    render_page(template, "index.html", latest, now,
+                subtitle="Overview of recent Ganeti QA test runs",
+                older_page=older_page, archive_pages=archive_pages,
+                slower_tests=[dict(test,
+                                   duration=fmt_duration(test["duration"]),
+                                   baseline=fmt_duration(test["baseline"]),
+                                   slowdown="+{:.0%}".format(
+                                       test["duration"] / max(test["baseline"], TEST_BASELINE_MIN_SECONDS) - 1))
+                              for test in slower_tests])
+
+    active = db.execute("SELECT id, mtime, data FROM runs WHERE state = 'running' ORDER BY started, id").fetchall()
+    render_page(template, "active.html", active, now,
+                subtitle="Ganeti QA test runs which are currently running",
+                archive_pages=archive_pages)
 
 
 if __name__ == "__main__":